@@ -0,0 +1,240 @@
+import os
+import math
+import time
+import asyncio
+import hashlib
+from collections import deque
+from typing import Deque, Dict, Iterable, Optional
+from starlette.responses import JSONResponse
+from lru import LRUCache
+from metrics import registry
+
+class AdmissionConfig:
+    ENABLED = os.getenv("ADMISSION_CONTROL", "true").lower() in ("1", "true", "yes")
+    # Requests to /agent served at once; each holds its slot until its stream ends.
+    MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "64"))
+    QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "128"))
+    QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))
+    # Per X-GitHub-Token: sustained requests per second, burst size and
+    # concurrent requests. Zero disables the rate or concurrency limit.
+    USER_RATE = float(os.getenv("ADMISSION_USER_RATE", "1"))
+    USER_BURST = float(os.getenv("ADMISSION_USER_BURST", "10"))
+    USER_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_USER_MAX_IN_FLIGHT", "4"))
+    MAX_USERS = int(os.getenv("ADMISSION_MAX_USERS", "10000"))
+
+ADMISSION_REJECTED = registry.counter("admission_rejected_total", "Requests shed by admission control, by reason.", ["reason"])
+ADMISSION_WAIT_SECONDS = registry.histogram("admission_wait_seconds", "Time admitted requests spent queued for a slot.")
+
+class AdmissionRejected(RuntimeError):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f"Request rejected ({reason}), retry after {retry_after:.1f}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Take one token, returning 0 on success or the seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class UserState:
+    def __init__(self, rate: float, burst: float):
+        self.bucket = TokenBucket(rate, burst)
+        # Admitted plus queued requests.
+        self.in_flight = 0
+
+class AdmissionController:
+    """Global concurrency cap with a bounded FIFO wait queue, plus per-user limits.
+
+    A request first passes its user's token bucket and concurrency limit,
+    then takes a global slot or waits for one in the queue until
+    ``queue_timeout``. Anything that cannot be admitted raises
+    :class:`AdmissionRejected` with a ``retry_after`` hint instead of waiting
+    indefinitely. Slots are handed directly to the oldest waiter on release.
+    """
+
+    def __init__(self, max_in_flight: int = AdmissionConfig.MAX_IN_FLIGHT, queue_size: int = AdmissionConfig.QUEUE_SIZE,
+                 queue_timeout: float = AdmissionConfig.QUEUE_TIMEOUT, user_rate: float = AdmissionConfig.USER_RATE,
+                 user_burst: float = AdmissionConfig.USER_BURST, user_max_in_flight: int = AdmissionConfig.USER_MAX_IN_FLIGHT,
+                 max_users: int = AdmissionConfig.MAX_USERS):
+        self.max_in_flight = max_in_flight
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.user_max_in_flight = user_max_in_flight
+        # No TTL: a user holding a long stream must not be forgotten mid-stream.
+        self.users = LRUCache(maxsize=max_users)
+        self.in_flight = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+        # Smoothed time a slot is held, used to estimate Retry-After.
+        self.hold_seconds = 1.0
+        self.admitted = 0
+        self.rejected = 0
+
+    @staticmethod
+    def user_key(token: Optional[str], fallback: str = "anonymous") -> str:
+        if not token:
+            return fallback
+        # Never keep raw tokens in memory longer than the request does.
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()[:32]
+
+    def _user(self, key: str) -> UserState:
+        user = self.users.get(key)
+        if user is None:
+            user = UserState(self.user_rate, self.user_burst)
+            self.users.set(key, user)
+        return user
+
+    def _reject(self, reason: str, retry_after: float):
+        self.rejected += 1
+        ADMISSION_REJECTED.inc(reason=reason)
+        raise AdmissionRejected(reason, retry_after)
+
+    def _queue_retry_after(self) -> float:
+        return self.hold_seconds * (len(self.waiters) + 1) / max(1, self.max_in_flight)
+
+    async def acquire(self, key: str) -> "Admission":
+        user = self._user(key)
+        if self.user_max_in_flight > 0 and user.in_flight >= self.user_max_in_flight:
+            self._reject("user_concurrency", self.hold_seconds)
+        wait = user.bucket.take() if self.user_rate > 0 else 0.0
+        if wait > 0:
+            self._reject("user_rate", wait)
+
+        # Queued requests count toward the user's limit too, so one token
+        # cannot fill the shared queue while the global cap is reached.
+        user.in_flight += 1
+        try:
+            await self._acquire_slot()
+        except BaseException:
+            user.in_flight -= 1
+            raise
+
+        self.admitted += 1
+        return Admission(self, user)
+
+    async def _acquire_slot(self):
+        start = time.monotonic()
+        if self.in_flight < self.max_in_flight and not self.waiters:
+            self.in_flight += 1
+        elif len(self.waiters) >= self.queue_size:
+            self._reject("queue_full", self._queue_retry_after())
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if waiter.done() and not waiter.cancelled():
+                    # The slot was handed over just as we gave up; pass it on.
+                    self._release_slot()
+                else:
+                    waiter.cancel()
+                    self._remove(waiter)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                self._reject("queue_timeout", self._queue_retry_after())
+            ADMISSION_WAIT_SECONDS.observe(time.monotonic() - start)
+
+    def _remove(self, waiter: asyncio.Future):
+        try:
+            self.waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    def _release_slot(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                # Hand the slot over without freeing it, so newcomers cannot jump the queue.
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def release(self, user: UserState, held: float):
+        user.in_flight -= 1
+        self.hold_seconds += 0.1 * (held - self.hold_seconds)
+        self._release_slot()
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        return {
+            "in_flight": self.in_flight,
+            "queued": len(self.waiters),
+            "users": len(self.users),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "hold_seconds": round(self.hold_seconds, 3),
+        }
+
+class Admission:
+    """A held slot; release it exactly once when the response has finished."""
+
+    def __init__(self, controller: AdmissionController, user: UserState):
+        self.controller = controller
+        self.user = user
+        self.start = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller.release(self.user, time.monotonic() - self.start)
+
+class AdmissionMiddleware:
+    """ASGI middleware applying :class:`AdmissionController` to ``paths``.
+
+    The slot is held until the app returns, i.e. until the whole response
+    body, including a long-lived SSE stream, has been sent or the client has
+    gone away. Rejections are ``429`` responses with a ``Retry-After`` header.
+    """
+
+    def __init__(self, app, controller: AdmissionController, paths: Iterable[str] = ("/agent",)):
+        self.app = app
+        self.controller = controller
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        token = None
+        for name, value in scope["headers"]:
+            if name.lower() == b"x-github-token":
+                token = value.decode("latin-1")
+                break
+        client = scope.get("client")
+        key = self.controller.user_key(token, fallback=f"client:{client[0]}" if client else "anonymous")
+
+        try:
+            admission = await self.controller.acquire(key)
+        except AdmissionRejected as e:
+            retry_after = str(max(1, math.ceil(min(e.retry_after, 3600))))
+            await JSONResponse({"error": "Too many requests", "reason": e.reason}, status_code=429,
+                               headers={"Retry-After": retry_after})(scope, receive, send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            admission.release()
+
+admission_controller = AdmissionController()
+
+registry.callback_gauge(
+    "admission", "Admission control in-flight, queued, admitted and rejected counts.", ["stat"],
+    lambda: [((name,), value) for name, value in admission_controller.stats.items()],
+)
@@ -1,21 +1,33 @@
 import os
+import time
 import asyncio
-import aiohttp
 
-import json
+import fast_json
 from typing import Any
 from datetime import datetime
 from sse_starlette.sse import EventSourceResponse
 from starlette.responses import JSONResponse, StreamingResponse
 from embedding import EmbeddingService
-from copilot import CopilotService as Copilot
+from embedding_cache import EmbeddingCache
+from retrieval import Retriever
+from shared_index import SharedIndex, SharedIndexConfig
+from reindex import ReindexConfig, diff_signatures, scan_directory
+from tools import ToolContext, ToolRegistry, ToolResult
+from metrics import stage
+from resilience import chat_resilience
+from semantic_cache import SemanticCache
+from history import budget_messages
+from fast_json import request_json
+from copilot import CopilotService as Copilot, ToolCallAssembler
+from upstream import upstream_client
+from github import format_issue, github_client
 from collections import OrderedDict
 
 async def create_embedding(content, integration_id, api_token):
-    return await EmbeddingService.create_embedding(content, integration_id, api_token)
+    return await EmbeddingService.cached_embedding(content, integration_id, api_token)
 
-async def generate_datasets(integration_id, api_token, filenames):
-    return await EmbeddingService.generate_datasets(integration_id, api_token, filenames)
+async def generate_datasets(integration_id, api_token, filenames, cache=None):
+    return await EmbeddingService.generate_datasets(integration_id, api_token, filenames, cache)
 
 async def find_best_dataset(datasets, target_embedding):
     return EmbeddingService.find_best_dataset(datasets, target_embedding)
@@ -24,9 +36,28 @@ async def find_best_dataset(datasets, target_embedding):
 DONE = b"data: [DONE]\n\n"
 
 class AgentService:
+    stream_function_calls = os.getenv("FUNCTION_CALLING_STREAM", "true").lower() in ("1", "true", "yes")
+    # Pass-through coalescing: flush once this many bytes are buffered or this
+    # many seconds have passed since the last flush. Zero flushes every read.
+    sse_flush_bytes = int(os.getenv("SSE_FLUSH_BYTES", "4096"))
+    sse_flush_interval = float(os.getenv("SSE_FLUSH_INTERVAL", "0"))
+
     def __init__(self):
         self.datasets = []
+        self.retriever = Retriever()
+        self.semantic_cache = SemanticCache()
+        self.embedding_cache = EmbeddingCache(EmbeddingService.model_embeddings)
+        # Workers attach one memory-mapped index instead of each holding a copy.
+        self.shared_index = SharedIndex() if SharedIndexConfig.ENABLED else None
         self.datasets_initialized = False
+        self.datasets_error = None
+        self._datasets_task = None
+        # When a partial build may be retried; see start_initialize_datasets.
+        self._datasets_retry_at = 0.0
+        self.data_dir = ReindexConfig.DATA_DIR
+        # File signatures of the data directory as of the published snapshot.
+        self.data_signatures = {}
+        self._reindex_lock = asyncio.Lock()
 
         list_properties = OrderedDict()
         list_properties["repository_owner"] = {
@@ -56,46 +87,153 @@ class AgentService:
             "description": "The content of the issue being created",
         }
 
-        self.tools = [
-            {
-                "type": "function",
-                "function": {
-                    "name": "list_issues",
-                    "description": "Fetch a list of issues from github.com for a given repository. Users may specify the repository owner and the repository name separately, or they may specify it in the form {repository_owner}/{repository_name}, or in the form github.com/{repository_owner}/{repository_name}.",
-                    "parameters": {
-                        "type": "object",
-                        "properties": list_properties,
-                        "required": ["repository_owner", "repository_name"],
-                    },
-                },
+        self.tool_registry = ToolRegistry()
+        self.tool_registry.register(
+            "list_issues",
+            "Fetch a list of issues from github.com for a given repository. Users may specify the repository owner and the repository name separately, or they may specify it in the form {repository_owner}/{repository_name}, or in the form github.com/{repository_owner}/{repository_name}.",
+            list_properties,
+            ["repository_owner", "repository_name"],
+        )(self.list_issues)
+        self.tool_registry.register(
+            "create_issue_dialog",
+            "Creates a confirmation dialog in which the user can interact with in order to create an issue on a github.com repository. Only one dialog should be created for each issue/repository combination. Users may specify the repository owner and the repository name separately, or they may specify it in the form {repository_owner}/{repository_name}, or in the form github.com/{repository_owner}/{repository_name}.",
+            create_properties,
+            ["repository_owner", "repository_name", "issue_title", "issue_body"],
+        )(self.create_issue_dialog)
+        self.tools = self.tool_registry.definitions
+
+    async def list_issues(self, context: ToolContext, args: dict) -> ToolResult:
+        owner, repo = args["repository_owner"], args["repository_name"]
+        issues = await github_client.list_issues(context.api_token, owner, repo)
+        if not issues:
+            return ToolResult(f"There are no open issues in {owner}/{repo}")
+        lines = "\n".join(format_issue(issue) for issue in issues)
+        return ToolResult(f"Open issues in {owner}/{repo} (up to {len(issues)}):\n{lines}")
+
+    async def create_issue_dialog(self, context: ToolContext, args: dict) -> ToolResult:
+        if context.confirmations:
+            return ToolResult("An issue dialog was already created for this request")
+
+        confirmation = {
+            "type": "action",
+            "title": "Create Issue",
+            "message": f"Are you sure you want to create an issue in repository {args['repository_owner']}/{args['repository_name']} with the title \"{args['issue_title']}\" and the content \"{args['issue_body']}\"",
+            "confirmation": {
+                "owner": args["repository_owner"],
+                "repo": args["repository_name"],
+                "title": args["issue_title"],
+                "body": args["issue_body"],
             },
-            {
-                "type": "function",
-                "function": {
-                    "name": "create_issue_dialog",
-                    "description": "Creates a confirmation dialog in which the user can interact with in order to create an issue on a github.com repository. Only one dialog should be created for each issue/repository combination. Users may specify the repository owner and the repository name separately, or they may specify it in the form {repository_owner}/{repository_name}, or in the form github.com/{repository_owner}/{repository_name}.",
-                    "parameters": {
-                        "type": "object",
-                        "properties": create_properties,
-                        "required": ["repository_owner", "repository_name", "issue_title", "issue_body"],
-                    },
-                },
-            },
-        ]
+        }
+        context.confirmations.append(confirmation)
+        print(f"Creating issue dialog: {fast_json.dumps(confirmation)}")
+
+        return ToolResult(
+            "Issue dialog created",
+            events=[dict(event="copilot_confirmation", data=fast_json.dumps(confirmation))],
+        )
+
+    @property
+    def datasets_status(self) -> str:
+        if self.datasets_initialized:
+            return "ready"
+        if self.retriever.snapshot.missing:
+            return "partial"
+        if self._datasets_task is not None and not self._datasets_task.done():
+            return "initializing"
+        if self.datasets_error is not None:
+            return "failed"
+        return "pending"
+
+    def start_initialize_datasets(self, integration_id, api_token) -> asyncio.Task:
+        """Start dataset initialization, or return the one already in flight.
+
+        A partial build is retried no sooner than ``DATA_WATCH_RETRY_INTERVAL``
+        after it finished.
+        """
+        if self._datasets_task is None or (self._datasets_task.done() and not self.datasets_initialized
+                                           and time.monotonic() >= self._datasets_retry_at):
+            self._datasets_task = asyncio.create_task(self._initialize_datasets(integration_id, api_token))
+        return self._datasets_task
 
     async def initialize_datasets(self, integration_id, api_token):
+        if self.datasets_initialized:
+            return
+
+        task = self.start_initialize_datasets(integration_id, api_token)
+        if self.retriever.snapshot.missing:
+            # Serve the partial snapshot while the missing chunks are retried.
+            return
+
+        # Shield the shared task so a disconnecting caller does not cancel it
+        # for everyone else waiting on it.
+        await asyncio.shield(task)
+
+    async def _initialize_datasets(self, integration_id, api_token):
+        try:
+            async with self._reindex_lock:
+                signatures = await asyncio.to_thread(scan_directory, self.data_dir)
+                missing = await self._build_datasets(integration_id, api_token, signatures)
+            if missing:
+                # Keep datasets_initialized unset so the failed chunks are embedded again later.
+                self.datasets_error = f"{missing} chunk(s) could not be embedded"
+                self._datasets_retry_at = time.monotonic() + ReindexConfig.RETRY_INTERVAL
+                print(f"Initialized datasets partially: {len(self.datasets)}, {self.datasets_error}; retrying in {ReindexConfig.RETRY_INTERVAL:.0f}s")
+                return
+            self.datasets_initialized = True
+            self.datasets_error = None
+            print(f"Initialized datasets: {len(self.datasets)}")
+        except Exception as e:
+            self.datasets_error = str(e)
+            if self.retriever.snapshot.missing:
+                self._datasets_retry_at = time.monotonic() + ReindexConfig.RETRY_INTERVAL
+            raise RuntimeError(f"Error initializing datasets: {e}")
+
+    async def _build_datasets(self, integration_id, api_token, signatures) -> int:
+        """Build and publish the index for ``signatures``, returning the number of chunks that failed to embed."""
+        filenames = sorted(signatures)
+        # Reload so chunks another worker embedded since our last build are reused.
+        await asyncio.to_thread(self.embedding_cache.load)
+        if self.shared_index is not None:
+            self.datasets = await self.retriever.load_or_build_shared(integration_id, api_token, filenames, self.embedding_cache, self.shared_index)
+        else:
+            self.datasets = await self.retriever.build(integration_id, api_token, filenames, self.embedding_cache)
+        missing = self.retriever.snapshot.missing
+        if not missing:
+            # A partial build leaves the old signatures, so the watcher retries it.
+            self.data_signatures = signatures
+        return missing
+
+    async def reindex_datasets(self, integration_id=None, api_token=None, signatures=None) -> bool:
+        """Rebuild the index if the data directory changed since the last build.
+
+        Unchanged chunks come from the embedding cache, so only added or
+        edited content is sent to /embeddings. The new snapshot is published
+        in one step; requests already running keep the one they started with.
+        Requires service credentials: per-request user tokens are never kept.
+        """
         if not self.datasets_initialized:
-            try:
-                data_dir = "data"
-                filenames = [os.path.join(data_dir, f) for f in os.listdir(data_dir)]
-                self.datasets = await generate_datasets(integration_id, api_token, filenames)
-                self.datasets_initialized = True
-                print(f"Initialized datasets: {len(self.datasets)}")
-            except Exception as e:
-                raise RuntimeError(f"Error initializing datasets: {e}")
+            return False
+
+        async with self._reindex_lock:
+            if signatures is None:
+                signatures = await asyncio.to_thread(scan_directory, self.data_dir)
+            if signatures == self.data_signatures:
+                return False
+
+            added, changed, removed = diff_signatures(self.data_signatures, signatures)
+            print(f"Reindexing datasets: {len(added)} added, {len(changed)} changed, {len(removed)} removed")
+            if not api_token:
+                raise RuntimeError("Reindexing requires COPILOT_API_TOKEN")
+            missing = await self._build_datasets(integration_id, api_token, signatures)
+            if missing:
+                raise RuntimeError(f"Reindexed datasets partially: {missing} chunk(s) could not be embedded")
+            print(f"Reindexed datasets: {len(self.datasets)} chunks, snapshot {self.retriever.snapshot.version}")
+            return True
 
     async def generate_completion(self, request):
-        body = await request.json()
+        with stage("body_parse"):
+            body = await request_json(request)
         user_message = body.get("messages", [])
 
         if not isinstance(user_message, list):
@@ -109,8 +247,17 @@ class AgentService:
             print("No message provided")
             return JSONResponse({"error": "No message provided"}, status_code=400)
 
+        # Only first-turn questions are cached: later turns depend on the
+        # conversation history, not just the last message and its context.
+        cache_control = request.headers.get("Cache-Control", "").lower()
+        use_cache = self.semantic_cache.enabled and not any(message.get("role") == "assistant" for message in user_message)
+        cache_lookup = use_cache and "no-cache" not in cache_control and "no-store" not in cache_control
+        cache_store = use_cache and "no-store" not in cache_control
+        cache_key = None
+
         try:
-            await self.initialize_datasets(integration_id, api_token)
+            with stage("dataset_init"):
+                await self.initialize_datasets(integration_id, api_token)
 
             # print(f"User message: {user_message}")
 
@@ -125,18 +272,44 @@ class AgentService:
                 message_content = message["content"]
                 # print(f"Processing message: {message_content}")
 
-                # Generate embedding for the user message
-                embedding = await create_embedding(message_content, integration_id, api_token)
-                # print(f"Generated embedding: {embedding}")
-                best_dataset = await find_best_dataset(self.datasets, embedding)
-
-                if not best_dataset:
+                # Keyword-heavy queries are answered from the BM25 index
+                # without a round trip to /embeddings.
+                # Hold one snapshot for the whole request so a concurrent
+                # reindex cannot pair these results with another build's text.
+                snapshot = self.retriever.snapshot
+                embedding = None
+                with stage("lexical_retrieval"):
+                    lexical, confident = self.retriever.retrieve_lexical(message_content, snapshot)
+                if confident:
+                    print("Confident lexical match, skipping query embedding")
+                    results = lexical[:self.retriever.config.TOP_K]
+                else:
+                    # Generate embedding for the user message
+                    with stage("query_embedding"):
+                        embedding = await create_embedding(message_content, integration_id, api_token)
+                    # print(f"Generated embedding: {embedding}")
+                    with stage("retrieval"):
+                        results = self.retriever.retrieve(embedding, lexical=lexical, snapshot=snapshot)
+
+                if not results:
                     return JSONResponse({"reply": "No suitable dataset found."})
 
-                print(f"Best dataset found: {best_dataset['filename']}")
+                retrieved = ", ".join(f"{chunk['filename']}#{chunk['chunk']} ({score:.3f})" for chunk, score in results)
+                print(f"Retrieved chunks: {retrieved}")
+
+                with stage("context_packing"):
+                    context = self.retriever.pack_context(results, snapshot=snapshot)
 
-                with open(best_dataset['filename'], "r") as file:
-                    context = file.read()
+                # The semantic cache is keyed by the query embedding, which a
+                # lexical hit never computes.
+                if use_cache and embedding is not None:
+                    cache_key = (embedding, EmbeddingCache.content_hash(context))
+                    if cache_lookup:
+                        with stage("semantic_cache_lookup"):
+                            cached = self.semantic_cache.lookup(*cache_key)
+                        if cached is not None:
+                            print("Semantic cache hit, replaying stored response")
+                            return StreamingResponse(self.semantic_cache.replay(cached), media_type="text/plain")
 
                 response_messages.append({
                     "role": "system",
@@ -147,13 +320,19 @@ class AgentService:
                 break
 
             response_messages.extend(user_message)
+            with stage("history_budget"):
+                response_messages, _ = budget_messages(response_messages)
             chat_request = {
                 "model": EmbeddingService.model_gpt35,
                 "messages": response_messages,
                 "stream": True,
             }
 
-            return StreamingResponse(self.stream_chat_completions(integration_id, api_token, chat_request), media_type="text/plain")
+            stream = self.stream_chat_completions(integration_id, api_token, chat_request)
+            if cache_store and cache_key is not None:
+                stream = self.semantic_cache.record(*cache_key, stream)
+
+            return StreamingResponse(stream, media_type="text/plain")
 
         except Exception as e:
             print(f"Error processing request: {e}")
@@ -161,7 +340,8 @@ class AgentService:
 
     async def function_calling(self, request):
         print("Function calling started")
-        body = await request.json()
+        with stage("body_parse"):
+            body = await request_json(request)
         integration_id = request.headers.get("Copilot-Integration-Id")
         api_token = request.headers.get("X-GitHub-Token")
         user_message = body.get("messages", [])
@@ -186,18 +366,17 @@ class AgentService:
 
             try:
                 print("Creating issue...")
-                # await create_issue(ctx, api_token, conf['confirmation']['owner'], conf['confirmation']['repo'], conf['confirmation']['title'], conf['confirmation']['body'])
-                await asyncio.sleep(1)  # Simulate issue creation
+                issue = await github_client.create_issue(api_token, conf['confirmation']['owner'], conf['confirmation']['repo'], conf['confirmation']['title'], conf['confirmation']['body'])
             except Exception as e:
                 raise RuntimeError(f"Error creating issue: {e}")
 
-            msg_json = json.dumps({
+            msg_json = fast_json.dumps({
                 "choices": [
                     {
                         "index": 0,
                         "delta": {
                             "role": "assistant",
-                            "content": f"Created issue {conf['confirmation']['title']} on repository {conf['confirmation']['owner']}/{conf['confirmation']['repo']}",
+                            "content": f"Created issue #{issue.get('number')} {conf['confirmation']['title']} on repository {conf['confirmation']['owner']}/{conf['confirmation']['repo']}: {issue.get('html_url', '')}",
                         },
                     },
                 ],
@@ -207,27 +386,50 @@ class AgentService:
             return
 
         messages = user_message[:]
-        confs = []
+        context = ToolContext(integration_id, api_token)
+        # Tool calls dispatched while their completion is still streaming.
+        started = {}
+        try:
+            async for event in self._function_calling_loop(messages, context, started, integration_id, api_token):
+                yield event
+        finally:
+            for task in started.values():
+                task.cancel()
 
+    async def _function_calling_loop(self, messages, context, started, integration_id, api_token):
         for i in range(5):
             print(f"Function calling iteration {i}")
+            with stage("history_budget"):
+                budgeted, _ = budget_messages(messages)
             chat_req = {
                 "model": EmbeddingService.model_gpt35,
-                "messages": messages,
+                "messages": budgeted,
             }
 
             if i < 4:
-                chat_req["tools"] = self.tools
+                chat_req["tools"] = self.tool_registry.definitions
 
             try:
                 # print(f"Chat request: {chat_req}")
-                res = await Copilot.chat_completions(chat_req, integration_id, api_token)
+                with stage("function_calling_completion"):
+                    if self.stream_function_calls:
+                        assembler = ToolCallAssembler()
+                        async for event in self._stream_completion(chat_req, integration_id, api_token, assembler, context, started):
+                            yield event
+                        res = assembler.result()
+                    else:
+                        res = await Copilot.chat_completions(chat_req, integration_id, api_token)
             except Exception as e:
                 raise RuntimeError(f"Failed to get chat completions stream: {e}")
 
-            function = Copilot.get_function_call(res)
+            tool_calls = Copilot.get_tool_calls(res)
 
-            if not function:
+            if not tool_calls and self.stream_function_calls:
+                print("No function call found, content already streamed")
+                yield dict(data="[DONE]")
+                break
+
+            if not tool_calls:
                 print("No function call found, sending the choice")
                 choices = [
                     {
@@ -240,86 +442,101 @@ class AgentService:
                     for choice in res["choices"]
                 ]
 
-                msg_json = json.dumps({"choices": choices})
+                msg_json = fast_json.dumps({"choices": choices})
                 yield dict(data=msg_json)
                 yield dict(data="[DONE]")
                 break
 
-            print("Found function!", function["name"])
-
-            if function["name"] == "list_issues":
-                args = json.loads(function["arguments"])
-                try:
-                    msg = {
-                        "role": "assistant",
-                        "content": "Listing issues for a/b",
-                    }
-                    messages.append(msg)
-                except Exception as e:
-                    raise RuntimeError(f"Error in list_issues: {e}")
-
-            elif function["name"] == "create_issue_dialog":
-                args = json.loads(function["arguments"])
-                try:
-                    conf = {
-                        "confirmation": {
-                            "type": "action",
-                            "title": "Create Issue",
-                            "message": f"Are you sure you want to create an issue in repository {args['repository_owner']}/{args['repository_name']} with the title \"{args['issue_title']}\" and the content \"{args['issue_body']}\"",
-                            "confirmation": {
-                                "owner": args["repository_owner"],
-                                "repo": args["repository_name"],
-                                "title": args["issue_title"],
-                                "body": args["issue_body"],
-                            },
-                        },
-                    }
+            print(f"Found tool calls: {', '.join(call['function']['name'] for call in tool_calls)}")
 
-                    msg = {
-                        "role": "system",
-                        "content": "Issue dialog created: abc",
-                    }
+            for n, call in enumerate(tool_calls):
+                if not call.get("id"):
+                    call["id"] = f"call_{i}_{n}"
 
-                    if not confs:
-                        confs.append(conf["confirmation"])
-                        print(f"Creating issue dialog: {json.dumps(confs[-1])}")
+            messages.append({
+                "role": "assistant",
+                "content": res["choices"][0]["message"].get("content"),
+                "tool_calls": tool_calls,
+            })
 
-                        try:
-                            yield dict(event="copilot_confirmation", data=json.dumps(confs[-1]))
-                        except Exception as e:
-                            raise RuntimeError(f"Failed to write event or data: {e}")
+            with stage("tool_dispatch"):
+                results = await self.tool_registry.dispatch(context, tool_calls, started)
+            for call, result in zip(tool_calls, results):
+                for event in result.events:
+                    yield event
 
-                        messages.append(msg)
-                except Exception as e:
-                    raise RuntimeError(f"Error in create_issue_dialog: {e}")
+                messages.append({
+                    "role": "tool",
+                    "tool_call_id": call["id"],
+                    "content": result.content,
+                })
 
-            else:
-                raise RuntimeError(f"Unknown function call: {function['name']}")
+    async def _stream_completion(self, chat_req, integration_id, api_token, assembler, context, started):
+        """Forward content deltas as SSE events while assembling tool calls.
+
+        Each tool call is started as soon as its arguments are complete, so
+        it runs while the rest of the completion is still streaming.
+        """
+        async for chunk in Copilot.stream_chat_completions(chat_req, integration_id, api_token):
+            for call in assembler.feed(chunk):
+                if call["function"]["name"]:
+                    self.tool_registry.start(context, call, started)
+
+            choices = [
+                {
+                    "index": choice.get("index", 0),
+                    "delta": {
+                        "role": "assistant",
+                        "content": choice["delta"]["content"],
+                    },
+                }
+                for choice in chunk.get("choices") or []
+                if (choice.get("delta") or {}).get("content")
+            ]
+            if choices:
+                yield dict(data=fast_json.dumps({"choices": choices}))
 
     async def stream_chat_completions(self, integration_id: str, api_token: str, chat_req: dict):
-        url = "https://api.githubcopilot.com/chat/completions"
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "Authorization": f"Bearer {api_token}",
-        }
-        if integration_id:
-            headers["Copilot-Integration-Id"] = integration_id
-
-        # Uncomment the following lines to send the actual request to the API
-
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, json=chat_req) as response:
-                if response.status != 200:
-                    error_message = await response.text()
-                    raise RuntimeError(f"Unexpected status code: {response.status}, {error_message}")
-
-                async for line in response.content:
-                    try:
-                        yield line
-                        yield b"\n"
-                    except Exception as e:
-                        raise RuntimeError(f"Failed to write to stream: {e}")
+        url = upstream_client.url("chat/completions")
+        headers = upstream_client.headers(api_token, integration_id)
+
+        response = await chat_resilience.call(
+            lambda: upstream_client.open("chat_completions_stream", url, headers=headers, data=fast_json.dumps_bytes(chat_req)))
+        async with response:
+            async for chunk in self._coalesce(response.content):
+                yield chunk
+
+    async def _coalesce(self, content):
+        """Forward upstream bytes unchanged, batching reads into fewer, larger sends."""
+        if self.sse_flush_interval <= 0:
+            # Flush every read, but still as whole reads rather than per line.
+            async for data in content.iter_any():
+                yield data
+            return
+
+        loop = asyncio.get_running_loop()
+        buffer = bytearray()
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - loop.time())
+            try:
+                data = await asyncio.wait_for(content.readany(), timeout)
+            except asyncio.TimeoutError:
+                data = None
+            else:
+                if not data:
+                    break
+                if not buffer:
+                    deadline = loop.time() + self.sse_flush_interval
+                buffer += data
+
+            if buffer and (data is None or len(buffer) >= self.sse_flush_bytes or loop.time() >= deadline):
+                yield bytes(buffer)
+                buffer.clear()
+                deadline = None
+
+        if buffer:
+            yield bytes(buffer)
 
 
 
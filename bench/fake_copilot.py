@@ -0,0 +1,119 @@
+"""Local stand-in for the Copilot API used by the benchmark harness.
+
+Serves ``/chat/completions`` (streaming and non-streaming, including
+``tool_calls`` responses) and ``/embeddings`` with configurable latency and
+token rate. Point the agent at it with ``COPILOT_API_URL``::
+
+    python -m bench.fake_copilot --port 9001 --latency 0.05 --token-rate 200
+"""
+import json
+import asyncio
+import hashlib
+import argparse
+import numpy as np
+from aiohttp import web
+
+class FakeCopilotConfig:
+    def __init__(self, latency: float = 0.05, token_rate: float = 200.0, tokens: int = 40,
+                 embedding_latency: float = 0.02, embedding_dim: int = 1536):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.tokens = tokens
+        self.embedding_latency = embedding_latency
+        self.embedding_dim = embedding_dim
+
+class FakeCopilot:
+    def __init__(self, config: FakeCopilotConfig):
+        self.config = config
+        self.requests = {"chat/completions": 0, "embeddings": 0}
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/chat/completions", self.chat_completions)
+        app.router.add_post("/embeddings", self.embeddings)
+        return app
+
+    def embedding(self, content: str):
+        seed = int.from_bytes(hashlib.sha256(content.encode("utf-8")).digest()[:8], "little")
+        return np.random.default_rng(seed).standard_normal(self.config.embedding_dim).astype(np.float32).tolist()
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        self.requests["embeddings"] += 1
+        body = await request.json()
+        await asyncio.sleep(self.config.embedding_latency)
+        data = [{"object": "embedding", "index": i, "embedding": self.embedding(content)} for i, content in enumerate(body["input"])]
+        return web.json_response({"object": "list", "data": data, "model": body.get("model")})
+
+    @staticmethod
+    def wants_tool(body) -> bool:
+        # Ask for a tool on the first turn only, so the loop finishes on the next iteration.
+        messages = body.get("messages", [])
+        return bool(body.get("tools")) and not any(message.get("role") == "tool" for message in messages)
+
+    @staticmethod
+    def tool_calls():
+        arguments = json.dumps({"repository_owner": "octo", "repository_name": "demo"})
+        return [{"id": "call_0", "type": "function", "function": {"name": "list_issues", "arguments": arguments}}]
+
+    def words(self):
+        return [f"token{i} " for i in range(self.config.tokens)]
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        self.requests["chat/completions"] += 1
+        body = await request.json()
+        await asyncio.sleep(self.config.latency)
+
+        if not body.get("stream"):
+            message = {"role": "assistant", "content": None}
+            if self.wants_tool(body):
+                message["tool_calls"] = self.tool_calls()
+                finish_reason = "tool_calls"
+            else:
+                await asyncio.sleep(self.config.tokens / self.config.token_rate)
+                message["content"] = "".join(self.words())
+                finish_reason = "stop"
+            return web.json_response({"choices": [{"index": 0, "message": message, "finish_reason": finish_reason}]})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(chunk):
+            await response.write(b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n")
+
+        if self.wants_tool(body):
+            call = self.tool_calls()[0]
+            arguments = call["function"]["arguments"]
+            half = len(arguments) // 2
+            await send({"choices": [{"index": 0, "delta": {"role": "assistant", "tool_calls": [
+                {"index": 0, "id": call["id"], "type": "function", "function": {"name": call["function"]["name"], "arguments": arguments[:half]}}]}}]})
+            await send({"choices": [{"index": 0, "delta": {"tool_calls": [{"index": 0, "function": {"arguments": arguments[half:]}}]}}]})
+            await send({"choices": [{"index": 0, "delta": {}, "finish_reason": "tool_calls"}]})
+        else:
+            delay = 1.0 / self.config.token_rate
+            for i, word in enumerate(self.words()):
+                delta = {"content": word}
+                if i == 0:
+                    delta["role"] = "assistant"
+                await send({"choices": [{"index": 0, "delta": delta}]})
+                await asyncio.sleep(delay)
+            await send({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9001)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds before the first byte of a completion")
+    parser.add_argument("--token-rate", type=float, default=200.0, help="streamed tokens per second")
+    parser.add_argument("--tokens", type=int, default=40, help="tokens per completion")
+    parser.add_argument("--embedding-latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    config = FakeCopilotConfig(args.latency, args.token_rate, args.tokens, args.embedding_latency)
+    web.run_app(FakeCopilot(config).app(), host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""A local stand-in for the GitHub issues API.
+
+Serves ``GET``/``POST /repos/{owner}/{repo}/issues`` from memory with
+``Link`` pagination and ``ETag``/``If-None-Match`` revalidation, so the
+issue tools can be exercised without touching api.github.com::
+
+    python -m bench.fake_github --port 9002
+"""
+import json
+import asyncio
+import hashlib
+import argparse
+from aiohttp import web
+from typing import Any, Dict, List, Tuple
+
+class FakeGitHub:
+    def __init__(self, issues_per_repo: int = 120, latency: float = 0.02):
+        self.issues_per_repo = issues_per_repo
+        self.latency = latency
+        self.repos: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+        self.requests = {"200": 0, "201": 0, "304": 0}
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/repos/{owner}/{repo}/issues", self.list_issues)
+        app.router.add_post("/repos/{owner}/{repo}/issues", self.create_issue)
+        return app
+
+    def issues(self, owner: str, repo: str) -> List[Dict[str, Any]]:
+        key = (owner, repo)
+        if key not in self.repos:
+            self.repos[key] = []
+            for number in range(1, self.issues_per_repo + 1):
+                self.add_issue(owner, repo, f"Issue {number} in {repo}", "")
+        return self.repos[key]
+
+    def add_issue(self, owner: str, repo: str, title: str, body: str) -> Dict[str, Any]:
+        issues = self.repos.setdefault((owner, repo), [])
+        number = len(issues) + 1
+        issue = {
+            "number": number,
+            "title": title,
+            "body": body,
+            "state": "open",
+            "user": {"login": "octocat"},
+            "labels": [{"name": "bug"}] if number % 3 == 0 else [],
+            "html_url": f"https://github.com/{owner}/{repo}/issues/{number}",
+        }
+        # Every fifth item is a pull request, as the real endpoint returns both.
+        if number % 5 == 0:
+            issue["pull_request"] = {"url": f"https://github.com/{owner}/{repo}/pull/{number}"}
+        issues.insert(0, issue)
+        return issue
+
+    async def list_issues(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.latency)
+        owner, repo = request.match_info["owner"], request.match_info["repo"]
+        per_page = int(request.query.get("per_page", "30"))
+        page = int(request.query.get("page", "1"))
+        issues = self.issues(owner, repo)
+        items = issues[(page - 1) * per_page:page * per_page]
+
+        body = json.dumps(items).encode("utf-8")
+        etag = '"' + hashlib.sha256(body).hexdigest()[:20] + '"'
+        headers = {"ETag": etag}
+        if page * per_page < len(issues):
+            query = dict(request.query, page=str(page + 1))
+            headers["Link"] = f'<{request.url.with_query(query)}>; rel="next"'
+
+        if request.headers.get("If-None-Match") == etag:
+            self.requests["304"] += 1
+            return web.Response(status=304, headers=headers)
+        self.requests["200"] += 1
+        return web.Response(body=body, headers=headers, content_type="application/json")
+
+    async def create_issue(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.latency)
+        owner, repo = request.match_info["owner"], request.match_info["repo"]
+        body = await request.json()
+        self.issues(owner, repo)
+        issue = self.add_issue(owner, repo, body.get("title", ""), body.get("body", ""))
+        self.requests["201"] += 1
+        return web.json_response(issue, status=201)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9002)
+    parser.add_argument("--issues", type=int, default=120, help="issues generated per repository")
+    parser.add_argument("--latency", type=float, default=0.02)
+    args = parser.parse_args()
+    web.run_app(FakeGitHub(args.issues, args.latency).app(), host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
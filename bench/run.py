@@ -0,0 +1,272 @@
+"""Load-test the agent against a local fake Copilot API.
+
+Starts :mod:`bench.fake_copilot` and :mod:`bench.fake_github` in-process,
+launches the app under uvicorn with ``COPILOT_API_URL`` and ``GITHUB_API_URL``
+pointing at them, drives ``/agent`` with concurrent SSE
+clients and reports RPS, p50/p95/p99 latency, time to first token and server
+memory (summed over the uvicorn supervisor and its workers) for each scenario::
+
+    python -m bench.run --requests 200 --concurrency 20
+    python -m bench.run --scenario rag --json bench_output.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import aiohttp
+from aiohttp import web
+from typing import Any, Dict, List, Optional
+from bench.fake_copilot import FakeCopilot, FakeCopilotConfig
+from bench.fake_github import FakeGitHub
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS: Dict[str, Dict[str, Any]] = {
+    "rag": {
+        "mode": "rag",
+        "messages": [{"role": "user", "content": "How should responses to the copilot platform be formatted?"}],
+    },
+    "function_calling": {
+        "mode": "function_calling",
+        "messages": [{"role": "user", "content": "List the issues in octo/demo"}],
+    },
+    "confirmation": {
+        "mode": "function_calling",
+        "messages": [{
+            "role": "user",
+            "content": "yes",
+            "confirmations": [{
+                "state": "accepted",
+                "confirmation": {"owner": "octo", "repo": "demo", "title": "Bug", "body": "It broke"},
+            }],
+        }],
+    },
+}
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+def process_tree(pid: int) -> List[int]:
+    """``pid`` and all of its descendants, e.g. the uvicorn supervisor and its workers (Linux only)."""
+    pids, queue = [], [pid]
+    while queue:
+        current = queue.pop()
+        pids.append(current)
+        try:
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as file:
+                    queue.extend(int(child) for child in file.read().split())
+        except OSError:
+            pass
+    return pids
+
+def read_kb(path: str, keys) -> Dict[str, int]:
+    values = {}
+    try:
+        with open(path) as file:
+            for line in file:
+                if line.startswith(keys):
+                    key, value = line.split(":", 1)
+                    values[key] = int(value.split()[0])
+    except OSError:
+        pass
+    return values
+
+def memory_kb(pid: int) -> Dict[str, Any]:
+    """Current RSS, peak RSS and PSS summed over ``pid`` and its descendants (Linux only).
+
+    RSS counts pages shared between workers (such as the memory-mapped
+    shared index) once per worker; PSS splits them between the processes
+    mapping them, so its sum is the real footprint.
+    """
+    memory: Dict[str, Any] = {"processes": []}
+    for current in process_tree(pid):
+        status = read_kb(f"/proc/{current}/status", ("VmRSS:", "VmHWM:"))
+        status.update(read_kb(f"/proc/{current}/smaps_rollup", ("Pss:",)))
+        if not status:
+            continue
+        memory["processes"].append({"pid": current, **status})
+        for key, value in status.items():
+            memory[key] = memory.get(key, 0) + value
+    return memory
+
+class AppProcess:
+    def __init__(self, mode: str, upstream_url: str, github_url: str, workers: int = 1):
+        self.port = free_port()
+        self.cache_dir = tempfile.mkdtemp(prefix="bench-cache-")
+        env = {
+            **os.environ,
+            "COPILOT_API_URL": upstream_url,
+            "GITHUB_API_URL": github_url,
+            "AGENT_MODE": mode,
+            "EMBEDDING_CACHE_DIR": self.cache_dir,
+            "INDEX_DIR": os.path.join(self.cache_dir, "index"),
+            # All bench requests share one token; keep only the global admission cap.
+            "ADMISSION_USER_RATE": "0",
+            "ADMISSION_USER_MAX_IN_FLIGHT": "0",
+            "PYTHONUNBUFFERED": "1",
+        }
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(self.port),
+             "--workers", str(workers), "--log-level", "warning"],
+            cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+        )
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    async def wait_ready(self, session: aiohttp.ClientSession, timeout: float = 30.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"App exited with code {self.process.returncode}")
+            try:
+                async with session.get(f"{self.url}/health") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.1)
+        raise RuntimeError("App did not become ready in time")
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+async def one_request(session: aiohttp.ClientSession, url: str, messages) -> Dict[str, Any]:
+    headers = {"X-GitHub-Token": "bench-token", "Copilot-Integration-Id": "bench"}
+    start = time.perf_counter()
+    ttft = None
+    async with session.post(f"{url}/agent", json={"messages": messages}, headers=headers) as response:
+        status = response.status
+        async for data in response.content.iter_any():
+            if ttft is None and b'"content"' in data:
+                ttft = time.perf_counter() - start
+    return {"status": status, "latency": time.perf_counter() - start, "ttft": ttft}
+
+async def run_scenario(name: str, upstream_url: str, github_url: str, requests: int, concurrency: int, warmup: int, workers: int) -> Dict[str, Any]:
+    scenario = SCENARIOS[name]
+    app = AppProcess(scenario["mode"], upstream_url, github_url, workers)
+    try:
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=120)) as session:
+            await app.wait_ready(session)
+            for _ in range(warmup):
+                await one_request(session, app.url, scenario["messages"])
+            baseline = memory_kb(app.process.pid)
+
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def bounded():
+                async with semaphore:
+                    try:
+                        return await one_request(session, app.url, scenario["messages"])
+                    except Exception as e:
+                        return {"status": None, "error": str(e)}
+
+            start = time.perf_counter()
+            results = await asyncio.gather(*(bounded() for _ in range(requests)))
+            elapsed = time.perf_counter() - start
+            memory = memory_kb(app.process.pid)
+    finally:
+        app.stop()
+
+    ok = [result for result in results if result.get("status") == 200]
+    latencies = [result["latency"] for result in ok]
+    ttfts = [result["ttft"] for result in ok if result.get("ttft") is not None]
+    return {
+        "scenario": name,
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": len(results) - len(ok),
+        "rps": len(ok) / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "ttft_p50": percentile(ttfts, 50),
+        "ttft_p95": percentile(ttfts, 95),
+        "rss_kb": memory.get("VmRSS"),
+        "rss_growth_kb": (memory.get("VmRSS") or 0) - (baseline.get("VmRSS") or 0),
+        "peak_rss_kb": memory.get("VmHWM"),
+        "pss_kb": memory.get("Pss"),
+        "processes": memory["processes"],
+    }
+
+def print_report(reports: List[Dict[str, Any]]):
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:.1f}"
+
+    def mb(value):
+        return "-" if value is None else f"{value / 1024:.1f}"
+
+    print(f"{'scenario':<18}{'rps':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'ttft50':>9}{'ttft95':>9}{'rss MB':>9}{'pss MB':>9}{'errors':>8}")
+    for report in reports:
+        print(f"{report['scenario']:<18}{report['rps']:>8.1f}{ms(report['p50']):>9}{ms(report['p95']):>9}{ms(report['p99']):>9}"
+              f"{ms(report['ttft_p50']):>9}{ms(report['ttft_p95']):>9}{mb(report['rss_kb']):>9}{mb(report['pss_kb']):>9}{report['errors']:>8}")
+
+async def main_async(args):
+    fake = FakeCopilot(FakeCopilotConfig(args.latency, args.token_rate, args.tokens, args.embedding_latency))
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    port = free_port()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    upstream_url = f"http://127.0.0.1:{port}"
+
+    github = FakeGitHub()
+    github_runner = web.AppRunner(github.app())
+    await github_runner.setup()
+    github_port = free_port()
+    await web.TCPSite(github_runner, "127.0.0.1", github_port).start()
+    github_url = f"http://127.0.0.1:{github_port}"
+
+    reports = []
+    try:
+        for name in args.scenario or list(SCENARIOS):
+            reports.append(await run_scenario(name, upstream_url, github_url, args.requests, args.concurrency, args.warmup, args.workers))
+    finally:
+        await runner.cleanup()
+        await github_runner.cleanup()
+
+    print_report(reports)
+    print(f"Upstream requests: {fake.requests}")
+    print(f"GitHub responses: {github.requests}")
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(reports, file, indent=2)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS), help="scenario to run (repeatable, default: all)")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake upstream time to first byte in seconds")
+    parser.add_argument("--token-rate", type=float, default=200.0, help="fake upstream streamed tokens per second")
+    parser.add_argument("--tokens", type=int, default=40, help="tokens per fake completion")
+    parser.add_argument("--embedding-latency", type=float, default=0.02)
+    parser.add_argument("--json", help="also write the report to this JSON file")
+    asyncio.run(main_async(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
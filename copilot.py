@@ -1,44 +1,65 @@
-import aiohttp
-import json
+import fast_json
+from typing import Any, AsyncIterator, Dict, List, Optional
+from upstream import upstream_client
+from resilience import chat_resilience
 
 class CopilotService:
     @staticmethod
     async def chat_completions(req, integration_id, api_key):
         try:
-            body = json.dumps(req)
+            body = fast_json.dumps_bytes(req)
         except Exception as e:
             raise RuntimeError(f"Failed to marshal request: {e}")
 
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "Authorization": f"Bearer {api_key}",
-        }
-        if integration_id:
-            headers["Copilot-Integration-Id"] = integration_id
+        headers = upstream_client.headers(api_key, integration_id)
 
-        url = "https://api.githubcopilot.com/chat/completions"
+        url = upstream_client.url("chat/completions")
 
         # print(f"Request body: {body}")
 
-        async with aiohttp.ClientSession() as session:
-            try:
-                async with session.post(url, data=body, headers=headers) as response:
-                    if response.status != 200:
-                        error_body = await response.text()
-                        print(error_body)
-                        raise RuntimeError(f"Unexpected status code: {response.status}")
+        async def send():
+            async with upstream_client.post("chat_completions", url, data=body, headers=headers) as response:
+                try:
+                    return await response.json()
+                except Exception as e:
+                    raise RuntimeError(f"Failed to unmarshal response body: {e}")
 
-                    try:
-                        chat_res = await response.json()
-                    except Exception as e:
-                        raise RuntimeError(f"Failed to unmarshal response body: {e}")
+        try:
+            return await chat_resilience.call(send)
+        except Exception as e:
+            print(f"Error during chat_completion request: {e}")
+            raise RuntimeError(f"Failed to send request: {e}")
+
+    @staticmethod
+    async def stream_chat_completions(req, integration_id, api_key) -> AsyncIterator[Dict[str, Any]]:
+        """Post a streaming chat completion and yield each parsed SSE chunk."""
+        try:
+            body = fast_json.dumps_bytes({**req, "stream": True})
+        except Exception as e:
+            raise RuntimeError(f"Failed to marshal request: {e}")
 
-                    return chat_res
+        headers = upstream_client.headers(api_key, integration_id)
+        headers["Accept"] = "text/event-stream"
 
-            except Exception as e:
-                print(f"Error during chat_completion request: {e}")
-                raise RuntimeError(f"Failed to send request: {e}")
+        url = upstream_client.url("chat/completions")
+
+        # Retries only cover opening the stream; once chunks flow they cannot be replayed.
+        response = await chat_resilience.call(
+            lambda: upstream_client.open("chat_completions_stream", url, data=body, headers=headers))
+        async with response:
+            async for line in response.content:
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+
+                data = line[len(b"data:"):].strip()
+                if data == b"[DONE]":
+                    break
+
+                try:
+                    yield fast_json.loads(data)
+                except Exception as e:
+                    raise RuntimeError(f"Failed to unmarshal stream chunk: {e}")
 
     @staticmethod
     def get_function_call(res):
@@ -52,4 +73,81 @@ class CopilotService:
         if not func_call:
             return None
 
-        return func_call
\ No newline at end of file
+        return func_call
+
+    @staticmethod
+    def get_tool_calls(res):
+        if not res.get("choices"):
+            return []
+
+        return [call for call in res["choices"][0]["message"].get("tool_calls") or [] if call.get("function")]
+
+class ToolCallAssembler:
+    """Rebuild a non-streaming completion from streamed chat completion chunks.
+
+    Content deltas are concatenated per choice and ``tool_calls`` argument
+    fragments are joined by their ``index``. A tool call is complete once a
+    later call starts or its choice reports a ``finish_reason``.
+    """
+
+    def __init__(self):
+        self.choices: Dict[int, Dict[str, Any]] = {}
+
+    def _choice(self, index: int) -> Dict[str, Any]:
+        if index not in self.choices:
+            self.choices[index] = {"role": "assistant", "content": "", "tool_calls": {}, "finish_reason": None, "completed": 0}
+        return self.choices[index]
+
+    def feed(self, chunk: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Consume one chunk and return the tool calls it completed."""
+        completed = []
+        for delta_choice in chunk.get("choices") or []:
+            choice = self._choice(delta_choice.get("index", 0))
+            delta = delta_choice.get("delta") or {}
+
+            if delta.get("role"):
+                choice["role"] = delta["role"]
+            if delta.get("content"):
+                choice["content"] += delta["content"]
+
+            for fragment in delta.get("tool_calls") or []:
+                call_index = fragment.get("index", len(choice["tool_calls"]))
+                if call_index not in choice["tool_calls"]:
+                    completed.extend(self._complete(choice, below=call_index))
+                    choice["tool_calls"][call_index] = {"id": None, "type": "function", "function": {"name": "", "arguments": ""}}
+
+                call = choice["tool_calls"][call_index]
+                if fragment.get("id"):
+                    call["id"] = fragment["id"]
+                if fragment.get("type"):
+                    call["type"] = fragment["type"]
+                function = fragment.get("function") or {}
+                if function.get("name"):
+                    call["function"]["name"] += function["name"]
+                if function.get("arguments"):
+                    call["function"]["arguments"] += function["arguments"]
+
+            if delta_choice.get("finish_reason"):
+                choice["finish_reason"] = delta_choice["finish_reason"]
+                completed.extend(self._complete(choice))
+
+        return completed
+
+    @staticmethod
+    def _complete(choice: Dict[str, Any], below: Optional[int] = None) -> List[Dict[str, Any]]:
+        indices = sorted(choice["tool_calls"])
+        pending = [i for i in indices[choice["completed"]:] if below is None or i < below]
+        choice["completed"] += len(pending)
+        return [choice["tool_calls"][i] for i in pending]
+
+    def result(self) -> Dict[str, Any]:
+        """Return the assembled completion in the non-streaming response shape."""
+        choices = []
+        for index in sorted(self.choices):
+            choice = self.choices[index]
+            message = {"role": choice["role"], "content": choice["content"] or None}
+            if choice["tool_calls"]:
+                message["tool_calls"] = [choice["tool_calls"][i] for i in sorted(choice["tool_calls"])]
+            choices.append({"index": index, "message": message, "finish_reason": choice["finish_reason"]})
+
+        return {"choices": choices}
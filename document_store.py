@@ -0,0 +1,94 @@
+import os
+import mmap
+import asyncio
+import tempfile
+from typing import Any, Dict, List, Optional
+
+def read_documents(filenames: List[str]) -> List[Dict[str, Any]]:
+    """Read files into ``{"filename", "content"}`` documents, skipping unreadable ones.
+
+    This does blocking I/O; call it through :func:`load_documents` from async code.
+    """
+    documents = []
+    for filename in filenames:
+        try:
+            with open(filename, "r") as file:
+                documents.append({"filename": filename, "content": file.read()})
+        except Exception as e:
+            print(f"Error reading file {filename}: {e}")
+    return documents
+
+async def load_documents(filenames: List[str]) -> List[Dict[str, Any]]:
+    return await asyncio.to_thread(read_documents, filenames)
+
+class DocumentStore:
+    """Keeps chunk text in memory on the chunk itself."""
+
+    def put(self, chunks: List[Dict[str, Any]]):
+        pass
+
+    def text(self, chunk: Dict[str, Any]) -> str:
+        return chunk["content"]
+
+class MmapDocumentStore(DocumentStore):
+    """Writes chunk text to one UTF-8 file and serves it from a read-only memory map.
+
+    ``put`` replaces each chunk's ``content`` with an ``offset``/``length``
+    pair, so the text is paged in by the OS instead of held on the heap.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.path.join(os.getenv("RAG_DOCUMENT_STORE_DIR", os.path.join(".cache", "documents")), "chunks.bin")
+        self._file = None
+        self._mmap: Optional[mmap.mmap] = None
+
+    def put(self, chunks: List[Dict[str, Any]]):
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            offset = 0
+            with os.fdopen(fd, "wb") as file:
+                for chunk in chunks:
+                    data = chunk["content"].encode("utf-8")
+                    file.write(data)
+                    chunk["offset"] = offset
+                    chunk["length"] = len(data)
+                    offset += len(data)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+        self.open()
+        for chunk in chunks:
+            del chunk["content"]
+
+    def open(self):
+        """Map the existing file at ``path`` read-only."""
+        self.close()
+        self._file = open(self.path, "rb")
+        if os.fstat(self._file.fileno()).st_size:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def text(self, chunk: Dict[str, Any]) -> str:
+        if "content" in chunk:
+            return chunk["content"]
+        if self._mmap is None:
+            return ""
+        return self._mmap[chunk["offset"]:chunk["offset"] + chunk["length"]].decode("utf-8")
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def create_document_store(kind: Optional[str] = None) -> DocumentStore:
+    kind = kind or os.getenv("RAG_DOCUMENT_STORE", "memory")
+    if kind == "mmap":
+        return MmapDocumentStore()
+    return DocumentStore()
@@ -1,85 +1,252 @@
-import math
 import os
-import aiohttp
-import json
+import fast_json
+import asyncio
 import traceback
-from typing import List, Dict, Any
+import numpy as np
+from typing import List, Dict, Any, Optional, Sequence, Tuple
+from upstream import upstream_client
+from embedding_cache import EmbeddingCache
+from lru import LRUCache
+from resilience import embeddings_resilience
+from document_store import load_documents
 
 class EmbeddingService:
     model_gpt35 = "gpt-3.5-turbo"
     model_gpt4 = "gpt-4"
     model_embeddings = "text-embedding-ada-002"
 
+    batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", "16"))
+    batch_tokens = int(os.getenv("EMBEDDING_BATCH_TOKENS", "8000"))
+    batch_concurrency = int(os.getenv("EMBEDDING_BATCH_CONCURRENCY", "4"))
+
+    query_cache = LRUCache(
+        maxsize=int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "1024")),
+        ttl=float(os.getenv("QUERY_EMBEDDING_CACHE_TTL", "3600")),
+    )
+
+    @staticmethod
+    def estimate_tokens(content: str) -> int:
+        # Roughly four characters per token for English text with cl100k.
+        return len(content) // 4 + 1
+
     @staticmethod
     async def create_embedding(content: str, integration_id: str, api_token: str) -> List[float]:
+        embeddings = await EmbeddingService.create_embeddings([content], integration_id, api_token)
+        return embeddings[0]
+
+    @staticmethod
+    def normalize_query(content: str) -> str:
+        return " ".join(content.split()).casefold()
+
+    @staticmethod
+    async def cached_embedding(content: str, integration_id: str, api_token: str) -> List[float]:
+        """Embed a query through the in-memory LRU/TTL cache, coalescing concurrent misses."""
+        key = (EmbeddingService.model_embeddings, EmbeddingService.normalize_query(content))
+        return await EmbeddingService.query_cache.get_or_create(
+            key, lambda: EmbeddingService.create_embedding(content, integration_id, api_token))
+
+    @staticmethod
+    async def create_embeddings(contents: List[str], integration_id: str, api_token: str) -> List[List[float]]:
         try:
-            url = "https://api.githubcopilot.com/embeddings"
-            headers = {
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-                "Authorization": f"Bearer {api_token}",
-            }
-            if integration_id:
-                headers["Copilot-Integration-Id"] = integration_id
+            url = upstream_client.url("embeddings")
+            headers = upstream_client.headers(api_token, integration_id)
 
             payload = {
                 "model": EmbeddingService.model_embeddings,
-                "input": [content]
+                "input": contents
             }
 
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, headers=headers, json=payload) as response:
-                    if response.status != 200:
-                        error_message = await response.text()
-                        raise RuntimeError(f"Unexpected status code: {response.status}, {error_message}")
+            async def send():
+                async with upstream_client.post("embeddings", url, headers=headers, data=fast_json.dumps_bytes(payload)) as response:
+                    return await response.json()
 
-                    response_data = await response.json()
-                    if "data" in response_data and response_data["data"]:
-                        return response_data["data"][0]["embedding"]
+            # Embedding requests are idempotent, so they may be hedged.
+            response_data = await embeddings_resilience.call(send, hedge=True)
+            data = response_data.get("data") or []
+            if len(data) != len(contents):
+                raise RuntimeError(f"Expected {len(contents)} embeddings, got {len(data)}")
 
-                    raise RuntimeError("No embeddings found in response")
+            data = sorted(data, key=lambda item: item.get("index", 0))
+            return [item["embedding"] for item in data]
         except Exception as e:
             traceback.print_exc()
             raise RuntimeError(f"Unexpected error: {e}")
 
     @staticmethod
-    async def generate_datasets(integration_id: str, api_token: str, filenames: List[str]) -> List[Dict[str, Any]]:
-        datasets = []
-        for filename in filenames:
-            try:
-                with open(filename, "r") as file:
-                    file_content = file.read()
-
-                embedding = await EmbeddingService.create_embedding(file_content, integration_id, api_token)
-                datasets.append({
-                    "embedding": embedding,
-                    "filename": filename
-                })
-            except Exception as e:
-                raise RuntimeError(f"Error processing file {filename}: {e}")
+    def make_batches(contents: List[str], batch_size: int, batch_tokens: int) -> List[List[int]]:
+        """Group content indices into batches bounded by count and estimated tokens."""
+        batches = []
+        batch, tokens = [], 0
+        for i, content in enumerate(contents):
+            estimate = EmbeddingService.estimate_tokens(content)
+            if batch and (len(batch) >= batch_size or tokens + estimate > batch_tokens):
+                batches.append(batch)
+                batch, tokens = [], 0
+            batch.append(i)
+            tokens += estimate
+
+        if batch:
+            batches.append(batch)
+        return batches
 
-        return datasets
+    @staticmethod
+    async def embed_batched(contents: List[str], integration_id: str, api_token: str) -> List[Optional[List[float]]]:
+        """Embed contents in bounded-concurrency batches.
+
+        A failed batch is retried one input at a time so a single bad input
+        only loses its own embedding, which is returned as ``None``.
+        """
+        results: List[Optional[List[float]]] = [None] * len(contents)
+        semaphore = asyncio.Semaphore(max(1, EmbeddingService.batch_concurrency))
+
+        async def run(batch: List[int]):
+            async with semaphore:
+                try:
+                    embeddings = await EmbeddingService.create_embeddings([contents[i] for i in batch], integration_id, api_token)
+                    for i, embedding in zip(batch, embeddings):
+                        results[i] = embedding
+                    return
+                except Exception as e:
+                    if len(batch) == 1:
+                        print(f"Failed to embed input {batch[0]}: {e}")
+                        return
+                    print(f"Embedding batch of {len(batch)} failed, retrying individually: {e}")
+
+                for i in batch:
+                    try:
+                        results[i] = await EmbeddingService.create_embedding(contents[i], integration_id, api_token)
+                    except Exception as e:
+                        print(f"Failed to embed input {i}: {e}")
+
+        batches = EmbeddingService.make_batches(contents, EmbeddingService.batch_size, EmbeddingService.batch_tokens)
+        await asyncio.gather(*(run(batch) for batch in batches))
+        return results
 
     @staticmethod
-    def find_best_dataset(datasets: List[Dict[str, Any]], target_embedding: List[float]) -> Dict[str, Any]:
-        best_dataset = None
-        best_score = -1
+    async def generate_datasets(integration_id: str, api_token: str, filenames: List[str], cache: Optional[EmbeddingCache] = None) -> List[Dict[str, Any]]:
+        documents = await load_documents(filenames)
+        datasets = await EmbeddingService.embed_documents(integration_id, api_token, documents, cache)
+        for dataset in datasets:
+            del dataset["content"]
 
-        target_magnitude = math.sqrt(sum(x * x for x in target_embedding))
+        if filenames and not datasets:
+            raise RuntimeError("Failed to embed any of the dataset files")
 
-        for dataset in datasets:
-            dataset_embedding = dataset["embedding"]
-            dot_product = sum(t * d for t, d in zip(target_embedding, dataset_embedding))
-            dataset_magnitude = math.sqrt(sum(d * d for d in dataset_embedding))
+        return datasets
 
-            if dataset_magnitude == 0 or target_magnitude == 0:
-                continue
+    @staticmethod
+    async def embed_documents(integration_id: str, api_token: str, documents: List[Dict[str, Any]], cache: Optional[EmbeddingCache] = None) -> List[Dict[str, Any]]:
+        """Attach ``embedding`` and ``hash`` to each document with a ``content`` key.
+
+        Cached embeddings are reused, the rest are embedded in batches, and
+        documents that fail to embed are skipped.
+        """
+        entries = []
+        for document in documents:
+            content_hash = EmbeddingCache.content_hash(document["content"])
+            entries.append({
+                **document,
+                "embedding": cache.get(content_hash) if cache else None,
+                "hash": content_hash,
+            })
+
+        missing = [entry for entry in entries if entry["embedding"] is None]
+        if missing:
+            embeddings = await EmbeddingService.embed_batched([entry["content"] for entry in missing], integration_id, api_token)
+            for entry, embedding in zip(missing, embeddings):
+                if embedding is None:
+                    continue
+                entry["embedding"] = cache.put(entry["hash"], embedding) if cache else embedding
+
+        datasets = [entry for entry in entries if entry["embedding"] is not None]
+        if len(datasets) < len(entries):
+            failed = sorted({entry.get("filename", "?") for entry in entries if entry["embedding"] is None})
+            print(f"Skipped {len(entries) - len(datasets)} input(s) that could not be embedded: {', '.join(failed)}")
+
+        if cache:
+            try:
+                await asyncio.to_thread(cache.save, [dataset["hash"] for dataset in datasets])
+            except Exception as e:
+                print(f"Failed to save embedding cache: {e}")
+
+        return datasets
 
-            similarity = dot_product / (target_magnitude * dataset_magnitude)
-            if similarity > best_score:
-                best_score = similarity
-                best_dataset = dataset
+    @staticmethod
+    def find_best_dataset(datasets: List[Dict[str, Any]], target_embedding: List[float]) -> Dict[str, Any]:
+        results = EmbeddingIndex(datasets).search(target_embedding, k=1)
+        if not results:
+            return None
+
+        return results[0][0]
+
+class EmbeddingIndex:
+    """Cosine-similarity index over pre-normalized float32 embeddings."""
+
+    def __init__(self, datasets: Optional[List[Dict[str, Any]]] = None):
+        self.datasets: List[Dict[str, Any]] = []
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self.valid = np.zeros(0, dtype=bool)
+        if datasets:
+            self.build(datasets)
+
+    def __len__(self) -> int:
+        return len(self.datasets)
+
+    @classmethod
+    def from_arrays(cls, datasets: List[Dict[str, Any]], matrix: np.ndarray, valid: np.ndarray, **kwargs) -> "EmbeddingIndex":
+        """Wrap an already normalized matrix, e.g. one memory-mapped from disk, without copying it."""
+        index = cls(**kwargs)
+        index.datasets = datasets
+        index.matrix = matrix
+        index.valid = valid
+        return index
 
-        return best_dataset
+    @staticmethod
+    def normalize(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        valid = norms[..., 0] > 0
+        return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0), valid
+
+    def build(self, datasets: List[Dict[str, Any]]):
+        self.datasets = list(datasets)
+        if not self.datasets:
+            self.matrix = np.zeros((0, 0), dtype=np.float32)
+            self.valid = np.zeros(0, dtype=bool)
+            return
+
+        matrix = np.asarray([dataset["embedding"] for dataset in self.datasets], dtype=np.float32)
+        matrix, self.valid = self.normalize(matrix)
+        self.matrix = np.ascontiguousarray(matrix)
+
+    def scores(self, target_embedding: Sequence[float]) -> np.ndarray:
+        """Return the cosine similarity of the target against every entry.
+
+        Entries with a zero-magnitude embedding score ``-inf``.
+        """
+        if not self.datasets:
+            return np.zeros(0, dtype=np.float32)
+
+        query, valid = self.normalize(np.asarray(target_embedding, dtype=np.float32))
+        if not valid:
+            return np.full(len(self.datasets), -np.inf, dtype=np.float32)
+
+        scores = self.matrix @ query
+        scores[~self.valid] = -np.inf
+        return scores
+
+    def search(self, target_embedding: Sequence[float], k: int = 1) -> List[Tuple[Dict[str, Any], float]]:
+        scores = self.scores(target_embedding)
+        if scores.size == 0 or k <= 0:
+            return []
+
+        k = min(k, scores.size)
+        if k < scores.size:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(scores.size)
+        top = top[np.argsort(-scores[top], kind="stable")]
+
+        return [(self.datasets[i], float(scores[i])) for i in top if np.isfinite(scores[i])]
 
 embedding_service = EmbeddingService()
\ No newline at end of file
@@ -0,0 +1,134 @@
+import os
+import json
+import fcntl
+import hashlib
+import tempfile
+import numpy as np
+from contextlib import contextmanager
+from typing import Dict, Iterable, Optional
+
+class EmbeddingCache:
+    """Content-addressed on-disk cache of embeddings for a single model.
+
+    Embeddings are stored as one float32 ``.npy`` matrix that is memory-mapped
+    on load, alongside a small JSON manifest mapping content hashes to rows.
+    The pair is written and read under an ``flock`` on the cache directory,
+    so workers sharing it never pair one writer's manifest with another's
+    matrix.
+    """
+
+    def __init__(self, model: str, directory: Optional[str] = None):
+        self.model = model
+        self.directory = directory or os.getenv("EMBEDDING_CACHE_DIR", os.path.join(".cache", "embeddings"))
+        self.rows: Dict[str, int] = {}
+        self.matrix: Optional[np.ndarray] = None
+        self.pending: Dict[str, np.ndarray] = {}
+
+    @property
+    def name(self) -> str:
+        return "".join(c if c.isalnum() or c in "-_." else "_" for c in self.model)
+
+    @property
+    def matrix_path(self) -> str:
+        return os.path.join(self.directory, f"{self.name}.npy")
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.directory, f"{self.name}.json")
+
+    @staticmethod
+    def content_hash(content: str) -> str:
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    @contextmanager
+    def _locked(self, exclusive: bool):
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(os.path.join(self.directory, f".{self.name}.lock"), os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+        finally:
+            os.close(fd)
+
+    def load(self):
+        """Blocking; call through ``asyncio.to_thread`` from async code."""
+        if not os.path.isdir(self.directory):
+            self.rows = {}
+            self.matrix = None
+            return
+        with self._locked(exclusive=False):
+            self._load()
+
+    def _load(self):
+        self.rows = {}
+        self.matrix = None
+        try:
+            with open(self.manifest_path, "r") as file:
+                manifest = json.load(file)
+            if manifest.get("model") != self.model:
+                return
+
+            matrix = np.load(self.matrix_path, mmap_mode="r")
+            hashes = manifest.get("hashes", [])
+            if matrix.ndim != 2 or matrix.shape[0] != len(hashes):
+                print(f"Ignoring inconsistent embedding cache at {self.directory}")
+                return
+
+            self.matrix = matrix
+            self.rows = {h: i for i, h in enumerate(hashes)}
+            print(f"Loaded {len(self.rows)} cached embeddings for {self.model}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Failed to load embedding cache: {e}")
+
+    def get(self, content_hash: str) -> Optional[np.ndarray]:
+        if content_hash in self.pending:
+            return self.pending[content_hash]
+
+        row = self.rows.get(content_hash)
+        if row is None or self.matrix is None:
+            return None
+
+        return self.matrix[row]
+
+    def put(self, content_hash: str, embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        self.pending[content_hash] = vector
+        return vector
+
+    def save(self, keep: Optional[Iterable[str]] = None):
+        """Write the cache to disk, optionally pruning hashes not in ``keep``."""
+        hashes = list(dict.fromkeys(list(self.rows) + list(self.pending)))
+        if keep is not None:
+            keep = set(keep)
+            hashes = [h for h in hashes if h in keep]
+
+        if not self.pending and hashes == list(self.rows):
+            return
+
+        vectors = [self.get(h) for h in hashes]
+        if vectors:
+            matrix = np.ascontiguousarray(np.stack(vectors), dtype=np.float32)
+        else:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+
+        with self._locked(exclusive=True):
+            self._atomic_write(self.matrix_path, lambda file: np.save(file, matrix), binary=True)
+            self._atomic_write(self.manifest_path, lambda file: json.dump({
+                "model": self.model,
+                "dim": int(matrix.shape[1]) if matrix.ndim == 2 else 0,
+                "hashes": hashes,
+            }, file), binary=False)
+            self.pending = {}
+            self._load()
+
+    def _atomic_write(self, path: str, write, binary: bool):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb" if binary else "w") as file:
+                write(file)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
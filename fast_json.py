@@ -0,0 +1,38 @@
+import os
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Set JSON_BACKEND=json to force the standard library even when orjson is installed.
+BACKEND = "orjson" if orjson is not None and os.getenv("JSON_BACKEND", "orjson") == "orjson" else "json"
+
+if BACKEND == "orjson":
+    def dumps_bytes(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+    def dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+
+    def loads(data: Union[bytes, bytearray, memoryview, str]) -> Any:
+        return orjson.loads(data)
+else:
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+    def dumps(obj: Any) -> str:
+        return _encoder.encode(obj)
+
+    def dumps_bytes(obj: Any) -> bytes:
+        return _encoder.encode(obj).encode("utf-8")
+
+    def loads(data: Union[bytes, bytearray, memoryview, str]) -> Any:
+        if isinstance(data, memoryview):
+            data = bytes(data)
+        return json.loads(data)
+
+async def request_json(request) -> Any:
+    """Parse a Starlette request body with the selected backend."""
+    return loads(await request.body())
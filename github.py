@@ -0,0 +1,142 @@
+import os
+import re
+import time
+import hashlib
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+from urllib.parse import quote
+import fast_json
+from lru import LRUCache
+from metrics import UPSTREAM_ERRORS, UPSTREAM_TTFB_SECONDS, registry
+from resilience import UpstreamError, parse_retry_after
+from upstream import upstream_client
+
+class GitHubConfig:
+    API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com").rstrip("/")
+    API_VERSION = os.getenv("GITHUB_API_VERSION", "2022-11-28")
+    PER_PAGE = int(os.getenv("GITHUB_PER_PAGE", "50"))
+    # Issues returned to the model by list_issues; later pages are never fetched.
+    MAX_ISSUES = int(os.getenv("GITHUB_MAX_ISSUES", "30"))
+    CACHE_SIZE = int(os.getenv("GITHUB_CACHE_SIZE", "1024"))
+
+GITHUB_REQUESTS = registry.counter("github_requests_total", "GitHub API requests, by endpoint and status code.", ["endpoint", "status"])
+
+LINK_NEXT = re.compile(r'<([^>]+)>\s*;\s*rel="next"')
+
+class GitHubClient:
+    """GitHub REST client on the shared upstream connection pool.
+
+    GET responses are cached per token and URL together with their ``ETag``
+    and revalidated with ``If-None-Match``; GitHub does not count ``304``
+    responses against the rate limit. Listings are paginated lazily by
+    following ``Link: rel="next"`` only as far as the caller iterates.
+    """
+
+    def __init__(self, config: GitHubConfig = GitHubConfig()):
+        self.config = config
+        self.cache = LRUCache(maxsize=config.CACHE_SIZE)
+        self.revalidated = 0
+        self.fetched = 0
+
+    def url(self, path: str) -> str:
+        return f"{self.config.API_URL}/{path.lstrip('/')}"
+
+    def headers(self, api_token: Optional[str]) -> Dict[str, str]:
+        headers = {
+            "Accept": "application/vnd.github+json",
+            "X-GitHub-Api-Version": self.config.API_VERSION,
+            "User-Agent": "copilot-agent",
+        }
+        if api_token:
+            headers["Authorization"] = f"Bearer {api_token}"
+        return headers
+
+    @staticmethod
+    def cache_key(api_token: Optional[str], url: str) -> Tuple[str, str]:
+        # Responses differ by token (private repos), but raw tokens are not kept as keys.
+        return hashlib.sha256((api_token or "").encode("utf-8")).hexdigest()[:32], url
+
+    async def _request(self, endpoint: str, method: str, url: str, **kwargs):
+        session = await upstream_client.session()
+        start = time.perf_counter()
+        try:
+            response = await session.request(method, url, **kwargs)
+        except Exception:
+            UPSTREAM_ERRORS.inc(endpoint=endpoint)
+            raise
+        UPSTREAM_TTFB_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+        GITHUB_REQUESTS.inc(endpoint=endpoint, status=str(response.status))
+        return response
+
+    async def get(self, endpoint: str, url: str, api_token: Optional[str]) -> Tuple[Any, Optional[str]]:
+        """GET ``url`` as JSON, returning the body and the ``rel="next"`` page URL."""
+        key = self.cache_key(api_token, url)
+        cached = self.cache.get(key)
+        headers = self.headers(api_token)
+        if cached is not None:
+            headers["If-None-Match"] = cached[0]
+
+        response = await self._request(endpoint, "GET", url, headers=headers)
+        async with response:
+            if response.status == 304 and cached is not None:
+                self.revalidated += 1
+                return cached[1], cached[2]
+            if response.status != 200:
+                UPSTREAM_ERRORS.inc(endpoint=endpoint)
+                raise UpstreamError(response.status, await response.text(), parse_retry_after(response.headers.get("Retry-After")))
+
+            self.fetched += 1
+            body = fast_json.loads(await response.read())
+            match = LINK_NEXT.search(response.headers.get("Link", ""))
+            next_url = match.group(1) if match else None
+            etag = response.headers.get("ETag")
+            if etag:
+                self.cache.set(key, (etag, body, next_url))
+            return body, next_url
+
+    async def iter_issues(self, api_token: Optional[str], owner: str, repo: str, state: str = "open") -> AsyncIterator[Dict[str, Any]]:
+        """Yield issues (not pull requests) page by page, fetching the next page only when needed."""
+        url = self.url(f"repos/{quote(owner, safe='')}/{quote(repo, safe='')}/issues?state={quote(state)}&per_page={self.config.PER_PAGE}")
+        while url:
+            issues, url = await self.get("github_issues", url, api_token)
+            for issue in issues:
+                if "pull_request" not in issue:
+                    yield issue
+
+    async def list_issues(self, api_token: Optional[str], owner: str, repo: str, limit: int = GitHubConfig.MAX_ISSUES, state: str = "open"):
+        issues = []
+        async for issue in self.iter_issues(api_token, owner, repo, state):
+            issues.append(issue)
+            if len(issues) >= limit:
+                break
+        return issues
+
+    async def create_issue(self, api_token: Optional[str], owner: str, repo: str, title: str, body: str) -> Dict[str, Any]:
+        url = self.url(f"repos/{quote(owner, safe='')}/{quote(repo, safe='')}/issues")
+        headers = self.headers(api_token)
+        headers["Content-Type"] = "application/json"
+        response = await self._request("github_create_issue", "POST", url, headers=headers,
+                                       data=fast_json.dumps_bytes({"title": title, "body": body}))
+        async with response:
+            if response.status != 201:
+                UPSTREAM_ERRORS.inc(endpoint="github_create_issue")
+                raise UpstreamError(response.status, await response.text(), parse_retry_after(response.headers.get("Retry-After")))
+            return fast_json.loads(await response.read())
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self.cache), "fetched": self.fetched, "revalidated": self.revalidated}
+
+def format_issue(issue: Dict[str, Any]) -> str:
+    labels = ", ".join(label.get("name", "") for label in issue.get("labels") or [] if isinstance(label, dict))
+    user = (issue.get("user") or {}).get("login", "?")
+    line = f"#{issue.get('number')} {issue.get('title', '')} (by {user}"
+    if labels:
+        line += f"; labels: {labels}"
+    return line + f") {issue.get('html_url', '')}"
+
+github_client = GitHubClient()
+
+registry.callback_gauge(
+    "github_cache", "GitHub response cache size and fetched/revalidated counts.", ["stat"],
+    lambda: [((name,), value) for name, value in github_client.stats.items()],
+)
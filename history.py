@@ -0,0 +1,126 @@
+import os
+import json
+from typing import Any, Dict, List, Tuple
+from embedding import EmbeddingService
+from metrics import registry
+
+class HistoryConfig:
+    MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", "6000"))
+    KEEP_RECENT = int(os.getenv("HISTORY_KEEP_RECENT", "4"))
+    # Tokens kept from the start of an older message when it must be truncated.
+    TRUNCATE_TOKENS = int(os.getenv("HISTORY_TRUNCATE_TOKENS", "200"))
+
+MESSAGE_OVERHEAD = 4
+TRUNCATED = " …[truncated]"
+
+HISTORY_TRIMMED_TOKENS = registry.counter("history_trimmed_tokens_total", "Estimated tokens removed from upstream payloads by history budgeting.")
+HISTORY_DROPPED_MESSAGES = registry.counter("history_dropped_messages_total", "Messages dropped from upstream payloads by history budgeting.")
+
+def estimate_message_tokens(message: Dict[str, Any]) -> int:
+    tokens = MESSAGE_OVERHEAD
+    content = message.get("content")
+    if isinstance(content, str):
+        tokens += EmbeddingService.estimate_tokens(content)
+    elif content:
+        tokens += EmbeddingService.estimate_tokens(json.dumps(content))
+    for call in message.get("tool_calls") or []:
+        function = call.get("function") or {}
+        tokens += EmbeddingService.estimate_tokens(function.get("name", "") + function.get("arguments", ""))
+    if message.get("copilot_references"):
+        tokens += EmbeddingService.estimate_tokens(json.dumps(message["copilot_references"]))
+    return tokens
+
+def estimate_messages_tokens(messages: List[Dict[str, Any]]) -> int:
+    return sum(estimate_message_tokens(message) for message in messages)
+
+def _units(messages: List[Dict[str, Any]]) -> List[List[int]]:
+    """Group message indices so an assistant tool_calls message stays with its tool results."""
+    units: List[List[int]] = []
+    for i, message in enumerate(messages):
+        if message.get("role") == "tool" and units:
+            units[-1].append(i)
+        else:
+            units.append([i])
+    return units
+
+def _truncate(content: str, tokens: int) -> str:
+    # estimate_tokens assumes about four characters per token.
+    limit = max(0, tokens * 4)
+    if len(content) <= limit:
+        return content
+    return content[:limit] + TRUNCATED
+
+def budget_messages(messages: List[Dict[str, Any]], max_tokens: int = HistoryConfig.MAX_TOKENS,
+                    keep_recent: int = HistoryConfig.KEEP_RECENT) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    """Fit a conversation into ``max_tokens`` estimated tokens.
+
+    System messages and the last ``keep_recent`` turns are kept. Messages
+    other than the newest lose their ``copilot_references`` first (older
+    turns before recent ones), older turns are then dropped oldest-first, and
+    finally the remaining non-system messages other than the newest are
+    truncated.
+    The input list is not modified. Returns the messages and a report of
+    what was trimmed.
+    """
+    original = estimate_messages_tokens(messages)
+    report = {"original_tokens": original, "tokens": original, "dropped_messages": 0, "compacted_messages": 0}
+    if original <= max_tokens:
+        return messages, report
+
+    messages = [dict(message) for message in messages]
+    total = original
+    units = _units(messages)
+    recent = {i for unit in units[-keep_recent:] for i in unit} if keep_recent > 0 else set()
+    last = len(messages) - 1
+
+    # 1. References are usually the bulkiest and least useful part; strip them
+    # from older turns first, then from recent ones, always sparing the newest.
+    order = [i for i in range(len(messages)) if i not in recent] + [i for i in sorted(recent) if i != last]
+    for i in order:
+        if total <= max_tokens:
+            break
+        message = messages[i]
+        if not message.get("copilot_references"):
+            continue
+        before = estimate_message_tokens(message)
+        message.pop("copilot_references")
+        total -= before - estimate_message_tokens(message)
+        report["compacted_messages"] += 1
+
+    # 2. Drop whole older turns, oldest first.
+    dropped = set()
+    for unit in units:
+        if total <= max_tokens:
+            break
+        if any(i in recent or messages[i].get("role") == "system" for i in unit):
+            continue
+        for i in unit:
+            total -= estimate_message_tokens(messages[i])
+            dropped.add(i)
+
+    # 3. Truncate what is left, largest first, never the newest message and
+    # never a system message (it carries the instructions and RAG context).
+    candidates = sorted(
+        (i for i, message in enumerate(messages)
+         if i not in dropped and i != last and message.get("role") != "system" and isinstance(message.get("content"), str)),
+        key=lambda i: -estimate_message_tokens(messages[i]),
+    )
+    for i in candidates:
+        if total <= max_tokens:
+            break
+        before = estimate_message_tokens(messages[i])
+        messages[i]["content"] = _truncate(messages[i]["content"], HistoryConfig.TRUNCATE_TOKENS)
+        after = estimate_message_tokens(messages[i])
+        if after < before:
+            total -= before - after
+            report["compacted_messages"] += 1
+
+    messages = [message for i, message in enumerate(messages) if i not in dropped]
+    report["tokens"] = total
+    report["dropped_messages"] = len(dropped)
+
+    HISTORY_TRIMMED_TOKENS.inc(original - total)
+    HISTORY_DROPPED_MESSAGES.inc(len(dropped))
+    print(f"Trimmed history from {original} to {total} tokens "
+          f"({report['dropped_messages']} dropped, {report['compacted_messages']} compacted)")
+    return messages, report
@@ -0,0 +1,104 @@
+import re
+import numpy as np
+from collections import Counter
+from typing import Any, Dict, List, Sequence, Tuple
+
+STOPWORDS = frozenset("""
+a an and are as at be but by can do does for from how i if in into is it its me my of on or so that the their then
+there these this to use using was what when where which who why will with you your
+""".split())
+
+def stem(token: str) -> str:
+    # Only fold plain plurals; anything smarter belongs to the vector side.
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+def tokenize(text: str) -> List[str]:
+    return [stem(token) for token in re.findall(r"[a-z0-9]+", text.lower()) if token not in STOPWORDS]
+
+class BM25Index:
+    """Okapi BM25 over chunk text, stored as a compressed inverted index.
+
+    Each term's postings are a slice of ``doc_ids``/``weights``, where the
+    weight is the term's full BM25 contribution to that chunk, so a query
+    is one vectorized add per term.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.datasets: List[Dict[str, Any]] = []
+        self.vocabulary: Dict[str, int] = {}
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.doc_ids = np.zeros(0, dtype=np.int32)
+        self.weights = np.zeros(0, dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self.datasets)
+
+    def build(self, datasets: List[Dict[str, Any]], texts: Sequence[str]):
+        self.datasets = list(datasets)
+        counts = [Counter(tokenize(text)) for text in texts]
+        lengths = np.asarray([sum(count.values()) for count in counts], dtype=np.float32)
+        average = float(lengths.mean()) if lengths.size and lengths.mean() > 0 else 1.0
+
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+        for doc, count in enumerate(counts):
+            for term, tf in count.items():
+                postings.setdefault(term, []).append((doc, tf))
+
+        self.vocabulary = {term: i for i, term in enumerate(postings)}
+        sizes = [len(entries) for entries in postings.values()]
+        self.offsets = np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+        self.doc_ids = np.fromiter((doc for entries in postings.values() for doc, _ in entries), dtype=np.int32, count=int(self.offsets[-1]))
+        tfs = np.fromiter((tf for entries in postings.values() for _, tf in entries), dtype=np.float32, count=int(self.offsets[-1]))
+
+        n = len(counts)
+        df = np.asarray(sizes, dtype=np.float32)
+        idf = np.log1p((n - df + 0.5) / (df + 0.5))
+        norm = self.k1 * (1 - self.b + self.b * lengths[self.doc_ids] / average)
+        self.weights = (np.repeat(idf, sizes) * tfs * (self.k1 + 1) / (tfs + norm)).astype(np.float32)
+
+    def search(self, query: str, k: int = 1) -> Tuple[List[Tuple[Dict[str, Any], float]], float, float]:
+        """Return the top ``k`` chunks, plus the confidence and query-term coverage of the best one.
+
+        Confidence is the best score over the score a chunk would get with
+        the highest weight for every query term, so it lies in ``[0, 1]``.
+        Coverage is the share of query terms found in the best chunk.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not self.datasets or k <= 0:
+            return [], 0.0, 0.0
+
+        scores = np.zeros(len(self.datasets), dtype=np.float32)
+        matched = np.zeros(len(self.datasets), dtype=np.int16)
+        ceiling = 0.0
+        for term in terms:
+            i = self.vocabulary.get(term)
+            if i is None:
+                continue
+            start, end = self.offsets[i], self.offsets[i + 1]
+            docs = self.doc_ids[start:end]
+            scores[docs] += self.weights[start:end]
+            matched[docs] += 1
+            ceiling += float(self.weights[start:end].max())
+
+        if ceiling == 0.0:
+            return [], 0.0, 0.0
+
+        k = min(k, int(np.count_nonzero(scores)))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        best = top[0]
+        return [(self.datasets[i], float(scores[i])) for i in top], float(scores[best]) / ceiling, float(matched[best]) / len(terms)
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[Tuple[Dict[str, Any], float]]], k: int, constant: int = 60) -> List[Tuple[Dict[str, Any], float]]:
+    """Merge ranked result lists by summing ``1 / (constant + rank)`` per chunk."""
+    fused: Dict[int, List[Any]] = {}
+    for ranking in rankings:
+        for rank, (chunk, _) in enumerate(ranking):
+            entry = fused.setdefault(id(chunk), [chunk, 0.0])
+            entry[1] += 1.0 / (constant + rank + 1)
+    results = sorted(fused.values(), key=lambda entry: -entry[1])[:k]
+    return [(chunk, score) for chunk, score in results]
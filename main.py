@@ -2,14 +2,23 @@ import secrets
 import json
 from authlib.integrations.starlette_client import OAuth
 from starlette.applications import Starlette
-from starlette.responses import JSONResponse, RedirectResponse, StreamingResponse
+from starlette.responses import JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
 from starlette.routing import Route
 from starlette.middleware.sessions import SessionMiddleware
 from sse_starlette.sse import EventSourceResponse
 import asyncio
 import uvicorn
 import os
+from contextlib import asynccontextmanager
 from agent import agent_service
+from embedding import EmbeddingService
+from upstream import upstream_client
+from github import github_client
+from metrics import MetricsMiddleware, registry
+from resilience import resiliences
+from reindex import DataWatcher
+from admission import AdmissionConfig, AdmissionMiddleware, admission_controller
+from verification import PublicKeyCache, SignatureVerificationMiddleware, VerificationConfig, create_key_source
 
 # Configuration
 class Config:
@@ -18,9 +27,17 @@ class Config:
     CLIENT_ID = os.getenv("CLIENT_ID", "your_client_id")
     CLIENT_SECRET = os.getenv("CLIENT_SECRET", "your_client_secret")
     SECRET_KEY = os.getenv("SECRET_KEY", secrets.token_hex(16))
+    EAGER_DATASETS = os.getenv("EAGER_DATASETS", "false").lower() in ("1", "true", "yes")
+    COPILOT_INTEGRATION_ID = os.getenv("COPILOT_INTEGRATION_ID")
+    COPILOT_API_TOKEN = os.getenv("COPILOT_API_TOKEN")
+    AGENT_MODE = os.getenv("AGENT_MODE", "function_calling")
 
 config = Config()
 
+public_keys = PublicKeyCache(create_key_source()) if VerificationConfig.ENABLED else None
+
+data_watcher = DataWatcher(agent_service, config.COPILOT_INTEGRATION_ID, config.COPILOT_API_TOKEN)
+
 oauth = OAuth()
 oauth.register(
     name="github",
@@ -48,7 +65,8 @@ async def post_auth(request):
 
 # Agent Handler
 async def agent_handler(request):
-    # return await agent_service.generate_completion(request)
+    if config.AGENT_MODE == "rag":
+        return await agent_service.generate_completion(request)
     return await agent_service.function_calling(request)
     # return await sse(request)
 
@@ -70,6 +88,42 @@ async def numbers(minimum, maximum):
         await asyncio.sleep(0.9)
         yield dict(data=i)
 
+async def health(request):
+    datasets = agent_service.datasets_status
+    body = {
+        "status": "ok",
+        "datasets": datasets,
+        "index_version": agent_service.retriever.snapshot.version,
+        "query_embedding_cache": EmbeddingService.query_cache.stats,
+        "semantic_cache": agent_service.semantic_cache.stats,
+        "upstream": {name: resilience.stats for name, resilience in resiliences.items()},
+        "admission": admission_controller.stats,
+        "github_cache": github_client.stats,
+    }
+    # A partial index still answers requests while its missing chunks are retried.
+    if config.EAGER_DATASETS and datasets not in ("ready", "partial"):
+        # Keep load balancers away until the eager warm-up has finished.
+        body["status"] = "starting" if datasets != "failed" else "unavailable"
+        return JSONResponse(body, status_code=503)
+    return JSONResponse(body)
+
+registry.callback_gauge(
+    "query_embedding_cache",
+    "Query embedding cache size and hit/miss/coalesced/eviction counters.",
+    ["stat"],
+    lambda: [((name,), value) for name, value in EmbeddingService.query_cache.stats.items()],
+)
+
+registry.callback_gauge(
+    "semantic_cache",
+    "Semantic response cache size and hit/miss/store/eviction counters.",
+    ["stat"],
+    lambda: [((name,), value) for name, value in agent_service.semantic_cache.stats.items()],
+)
+
+async def metrics(request):
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 # Routes
 routes = [
     Route("/auth/authorization", pre_auth),
@@ -77,12 +131,43 @@ routes = [
     Route("/agent", agent_handler, methods=["POST"]),
     Route("/", lambda request: JSONResponse({"message": "Welcome to the API!"})),
     Route("/sse", sse),
-    Route("/health", lambda request: JSONResponse({"status": "ok"})),
+    Route("/health", health),
+    Route("/metrics", metrics),
 ]
 
+# Lifespan
+def log_eager_init(task):
+    if not task.cancelled() and task.exception():
+        print(f"Eager dataset initialization failed: {task.exception()}")
+
+@asynccontextmanager
+async def lifespan(app):
+    await upstream_client.start()
+    if public_keys is not None:
+        await public_keys.start()
+    task = None
+    if config.EAGER_DATASETS:
+        task = agent_service.start_initialize_datasets(config.COPILOT_INTEGRATION_ID, config.COPILOT_API_TOKEN)
+        task.add_done_callback(log_eager_init)
+    data_watcher.start()
+    try:
+        yield
+    finally:
+        await data_watcher.stop()
+        if task is not None and not task.done():
+            task.cancel()
+        if public_keys is not None:
+            await public_keys.stop()
+        await upstream_client.close()
+
 # Application Setup
-app = Starlette(debug=True, routes=routes)
+app = Starlette(debug=True, routes=routes, lifespan=lifespan)
 app.add_middleware(SessionMiddleware, secret_key=config.SECRET_KEY)
+if AdmissionConfig.ENABLED:
+    app.add_middleware(AdmissionMiddleware, controller=admission_controller, paths=["/agent"])
+if public_keys is not None:
+    app.add_middleware(SignatureVerificationMiddleware, keys=public_keys, paths=["/agent"])
+app.add_middleware(MetricsMiddleware, paths=[route.path for route in routes])
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=int(config.PORT))
\ No newline at end of file
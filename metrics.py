@@ -0,0 +1,206 @@
+import time
+import bisect
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(value)}" for key, value in self.values.items()]
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+class CallbackGauge(Metric):
+    """Gauge whose samples are read from ``callback`` at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str], callback: Callable[[], Iterable[Tuple[Tuple[str, ...], float]]]):
+        super().__init__(name, help, labelnames)
+        self.callback = callback
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(value)}" for key, value in self.callback()]
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            # One slot per bucket plus +Inf, then sum and count.
+            state = self.values[key] = [0] * (len(self.buckets) + 3)
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, state in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, ('le', _number(bound)))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(state[-2])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {state[-1]}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def callback_gauge(self, name: str, help: str, labelnames: Sequence[str], callback) -> CallbackGauge:
+        return self.register(CallbackGauge(name, help, labelnames, callback))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                print(f"Failed to collect metric {metric.name}: {e}")
+                continue
+            lines.extend(metric.header())
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+REQUESTS = registry.counter("agent_requests_total", "HTTP requests handled, by path and status code.", ["path", "status"])
+REQUESTS_IN_FLIGHT = registry.gauge("agent_requests_in_flight", "HTTP requests currently being handled, including open streams.", ["path"])
+REQUEST_ERRORS = registry.counter("agent_request_errors_total", "HTTP requests that raised or returned a 5xx status.", ["path"])
+REQUEST_SECONDS = registry.histogram("agent_request_seconds", "Time from request start until the response body completed.", ["path"])
+FIRST_EVENT_SECONDS = registry.histogram("agent_first_event_seconds", "Time from request start until the first non-empty response body chunk.", ["path"])
+STAGE_SECONDS = registry.histogram("agent_stage_seconds", "Latency of each stage of request processing.", ["stage"])
+STAGE_ERRORS = registry.counter("agent_stage_errors_total", "Stages that raised an exception.", ["stage"])
+UPSTREAM_TTFB_SECONDS = registry.histogram("upstream_ttfb_seconds", "Time until upstream response headers arrive.", ["endpoint"])
+UPSTREAM_ERRORS = registry.counter("upstream_errors_total", "Upstream calls that failed or returned a non-200 status.", ["endpoint"])
+
+@contextmanager
+def stage(name: str):
+    """Time a processing stage into ``agent_stage_seconds`` and count its failures."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=name)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=name)
+
+class MetricsMiddleware:
+    """ASGI middleware recording request counts, in-flight requests and latencies.
+
+    Timing covers the whole response body, so long-lived SSE streams count as
+    in flight until they finish. Paths outside ``paths`` are labelled ``other``.
+    """
+
+    def __init__(self, app, paths: Iterable[str] = ()):
+        self.app = app
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        path = scope["path"] if scope["path"] in self.paths else "other"
+        start = time.perf_counter()
+        status = {"code": 500, "first": True}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            elif message["type"] == "http.response.body" and status["first"] and message.get("body"):
+                status["first"] = False
+                FIRST_EVENT_SECONDS.observe(time.perf_counter() - start, path=path)
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc(path=path)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception:
+            status["code"] = 500
+            raise
+        finally:
+            REQUESTS_IN_FLIGHT.dec(path=path)
+            REQUESTS.inc(path=path, status=str(status["code"]))
+            REQUEST_SECONDS.observe(time.perf_counter() - start, path=path)
+            if status["code"] >= 500:
+                REQUEST_ERRORS.inc(path=path)
@@ -0,0 +1,95 @@
+import os
+import time
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+class ReindexConfig:
+    DATA_DIR = os.getenv("DATA_DIR", "data")
+    # Seconds between scans of DATA_DIR; zero disables live reindexing.
+    INTERVAL = float(os.getenv("DATA_WATCH_INTERVAL", "2"))
+    # Seconds before a failed reindex of the same directory state is retried.
+    RETRY_INTERVAL = float(os.getenv("DATA_WATCH_RETRY_INTERVAL", "60"))
+
+Signatures = Dict[str, Tuple[int, int]]
+
+def scan_directory(directory: str) -> Signatures:
+    """Map each regular file in ``directory`` to its ``(mtime_ns, size)``."""
+    signatures = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                signatures[entry.path] = (stat.st_mtime_ns, stat.st_size)
+    return signatures
+
+def diff_signatures(old: Signatures, new: Signatures) -> Tuple[List[str], List[str], List[str]]:
+    added = sorted(path for path in new if path not in old)
+    changed = sorted(path for path in new if path in old and new[path] != old[path])
+    removed = sorted(path for path in old if path not in new)
+    return added, changed, removed
+
+class DataWatcher:
+    """Polls the data directory and asks the agent to reindex when it changes.
+
+    A change is only acted on once two consecutive scans agree, so files
+    still being written are not indexed half-way. Failed reindexes are
+    retried after ``retry_interval`` or on the next change to the directory;
+    until then requests keep using the previous snapshot.
+
+    Reindexing runs in the background with the service credentials only, so
+    the watcher stays off when ``COPILOT_API_TOKEN`` is not configured.
+    """
+
+    def __init__(self, agent, integration_id: Optional[str], api_token: Optional[str], interval: float = ReindexConfig.INTERVAL,
+                 retry_interval: float = ReindexConfig.RETRY_INTERVAL):
+        self.agent = agent
+        self.integration_id = integration_id
+        self.api_token = api_token
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self._pending: Optional[Signatures] = None
+        self._failed: Optional[Signatures] = None
+        self._retry_at = 0.0
+        self._loop: Optional[asyncio.Task] = None
+
+    async def check(self):
+        if not self.agent.datasets_initialized:
+            return
+
+        current = await asyncio.to_thread(scan_directory, self.agent.data_dir)
+        if current == self.agent.data_signatures or (current == self._failed and time.monotonic() < self._retry_at):
+            self._pending = None
+            return
+        if current != self._pending:
+            self._pending = current
+            return
+
+        self._pending = None
+        try:
+            await self.agent.reindex_datasets(self.integration_id, self.api_token, current)
+            self._failed = None
+        except Exception as e:
+            self._failed = current
+            self._retry_at = time.monotonic() + self.retry_interval
+            print(f"Failed to reindex datasets, retrying in {self.retry_interval:.0f}s: {e}")
+
+    async def _watch_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception as e:
+                print(f"Failed to scan {self.agent.data_dir}: {e}")
+
+    def start(self):
+        if self._loop is not None or self.interval <= 0:
+            return
+        if not self.api_token:
+            print("Live reindexing disabled: COPILOT_API_TOKEN is not set")
+            return
+        self._loop = asyncio.create_task(self._watch_loop())
+
+    async def stop(self):
+        if self._loop is not None:
+            self._loop.cancel()
+            self._loop = None
@@ -0,0 +1,256 @@
+import os
+import time
+import random
+import asyncio
+import aiohttp
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Dict, Optional
+from metrics import registry
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+class UpstreamError(RuntimeError):
+    def __init__(self, status: int, message: str = "", retry_after: Optional[float] = None):
+        super().__init__(f"Unexpected status code: {status}, {message}")
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        return self.status in RETRYABLE_STATUSES
+
+class CircuitOpenError(RuntimeError):
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"Circuit breaker {name} is open, retry in {retry_in:.1f}s")
+        self.retry_in = retry_in
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header given either in seconds or as an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, UpstreamError):
+        return error.retryable
+    return isinstance(error, (aiohttp.ClientConnectionError, aiohttp.ServerTimeoutError, asyncio.TimeoutError))
+
+class CircuitBreaker:
+    """Fails fast after consecutive upstream failures, probing again after ``recovery_timeout``."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.opened_total = 0
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return
+
+        elapsed = time.monotonic() - self.opened_at
+        if self.state == self.OPEN and elapsed >= self.recovery_timeout:
+            self.state = self.HALF_OPEN
+            self.probing = False
+
+        if self.state == self.HALF_OPEN and not self.probing:
+            # Let exactly one probe through; its outcome decides the next state.
+            self.probing = True
+            return
+
+        raise CircuitOpenError(self.name, max(0.0, self.recovery_timeout - elapsed))
+
+    def abandon(self):
+        """Forget a probe that ended without an outcome (e.g. it was cancelled)."""
+        self.probing = False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.opened_total += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+class Resilience:
+    """Deadline, jittered exponential retry, optional hedging and a circuit breaker around upstream calls."""
+
+    def __init__(self, name: str, max_attempts: int = 3, base_delay: float = 0.2, max_delay: float = 5.0,
+                 deadline: Optional[float] = 60.0, hedge_delay: Optional[float] = None,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.hedge_delay = hedge_delay
+        self.breaker = breaker or CircuitBreaker(name)
+        self.calls = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failures = 0
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        if retry_after is not None:
+            # Honoured as given; call() fails fast when it exceeds max_delay.
+            return retry_after
+        # Full jitter: uniform between zero and the capped exponential delay.
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    async def _attempt(self, fn: Callable[[], Awaitable[Any]], timeout: Optional[float], hedge: bool) -> Any:
+        self.breaker.allow()
+        try:
+            if hedge and self.hedge_delay is not None:
+                result = await asyncio.wait_for(self._hedged(fn), timeout)
+            else:
+                result = await asyncio.wait_for(fn(), timeout)
+        except asyncio.CancelledError:
+            # No outcome: let the next call probe instead of staying half-open forever.
+            self.breaker.abandon()
+            raise
+        except Exception as e:
+            if is_retryable(e):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            raise
+        self.breaker.record_success()
+        return result
+
+    async def _hedged(self, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Start a second copy of ``fn`` if the first is slower than ``hedge_delay``; first success wins."""
+        primary = asyncio.ensure_future(fn())
+        pending = {primary}
+        error = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=self.hedge_delay)
+            if done:
+                return primary.result()
+
+            self.hedges += 1
+            backup = asyncio.ensure_future(fn())
+            pending = {primary, backup}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is backup:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def call(self, fn: Callable[[], Awaitable[Any]], hedge: bool = False) -> Any:
+        """Run ``fn`` under the deadline, retrying retryable failures with backoff.
+
+        Only pass ``hedge=True`` for idempotent calls.
+        """
+        self.calls += 1
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            remaining = None if self.deadline is None else self.deadline - (time.monotonic() - start)
+            if remaining is not None and remaining <= 0:
+                self.failures += 1
+                raise asyncio.TimeoutError(f"{self.name} deadline of {self.deadline}s exceeded")
+
+            try:
+                return await self._attempt(fn, remaining, hedge)
+            except Exception as e:
+                attempt += 1
+                if not is_retryable(e) or attempt >= self.max_attempts:
+                    self.failures += 1
+                    raise
+
+                retry_after = getattr(e, "retry_after", None)
+                if retry_after is not None and retry_after > self.max_delay:
+                    # Retrying before the server asked would only be rejected
+                    # again; fail now and let the caller see retry_after.
+                    self.failures += 1
+                    raise
+                delay = self.backoff(attempt - 1, retry_after)
+                if self.deadline is not None and delay >= self.deadline - (time.monotonic() - start):
+                    self.failures += 1
+                    raise
+                self.retries += 1
+                print(f"Retrying {self.name} in {delay:.2f}s after: {e}")
+                await asyncio.sleep(delay)
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "breaker_opened": self.breaker.opened_total,
+            "calls": self.calls,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "failures": self.failures,
+        }
+
+def _env_float(name: str, default: Optional[str]) -> Optional[float]:
+    value = os.getenv(name, default)
+    return float(value) if value not in (None, "", "none") else None
+
+chat_resilience = Resilience(
+    "chat_completions",
+    max_attempts=int(os.getenv("UPSTREAM_CHAT_MAX_ATTEMPTS", "3")),
+    deadline=_env_float("UPSTREAM_CHAT_DEADLINE", "60"),
+    breaker=CircuitBreaker(
+        "chat_completions",
+        failure_threshold=int(os.getenv("UPSTREAM_BREAKER_THRESHOLD", "5")),
+        recovery_timeout=float(os.getenv("UPSTREAM_BREAKER_RECOVERY", "30")),
+    ),
+)
+
+embeddings_resilience = Resilience(
+    "embeddings",
+    max_attempts=int(os.getenv("UPSTREAM_EMBEDDINGS_MAX_ATTEMPTS", "3")),
+    deadline=_env_float("UPSTREAM_EMBEDDINGS_DEADLINE", "20"),
+    hedge_delay=_env_float("UPSTREAM_EMBEDDINGS_HEDGE_DELAY", None),
+    breaker=CircuitBreaker(
+        "embeddings",
+        failure_threshold=int(os.getenv("UPSTREAM_BREAKER_THRESHOLD", "5")),
+        recovery_timeout=float(os.getenv("UPSTREAM_BREAKER_RECOVERY", "30")),
+    ),
+)
+
+resiliences = {resilience.name: resilience for resilience in (chat_resilience, embeddings_resilience)}
+
+_BREAKER_STATES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+
+registry.callback_gauge(
+    "upstream_breaker_state", "Circuit breaker state (0 closed, 1 half-open, 2 open).", ["name"],
+    lambda: [((name,), _BREAKER_STATES[r.breaker.state]) for name, r in resiliences.items()],
+)
+registry.callback_gauge(
+    "upstream_resilience", "Upstream call, retry, hedge and failure counts.", ["name", "stat"],
+    lambda: [((name, stat), value) for name, r in resiliences.items() for stat, value in r.stats.items() if stat != "state"],
+)
@@ -0,0 +1,331 @@
+import os
+import re
+import asyncio
+import numpy as np
+from typing import List, Dict, Any, Optional, Sequence, Tuple
+from embedding import EmbeddingService, EmbeddingIndex
+from embedding_cache import EmbeddingCache
+from document_store import DocumentStore, create_document_store, load_documents
+from lexical import BM25Index, reciprocal_rank_fusion
+
+class RetrievalConfig:
+    CHUNK_TOKENS = int(os.getenv("RAG_CHUNK_TOKENS", "400"))
+    CHUNK_OVERLAP = int(os.getenv("RAG_CHUNK_OVERLAP", "50"))
+    TOP_K = int(os.getenv("RAG_TOP_K", "5"))
+    CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "3000"))
+    IVF_MIN_SIZE = int(os.getenv("RAG_IVF_MIN_SIZE", "4096"))
+    IVF_NPROBE = int(os.getenv("RAG_IVF_NPROBE", "8"))
+    IVF_ITERATIONS = int(os.getenv("RAG_IVF_ITERATIONS", "10"))
+    # Hybrid retrieval: answer from BM25 alone when its best chunk covers at
+    # least LEXICAL_MIN_COVERAGE of the query terms and scores at least
+    # LEXICAL_MIN_CONFIDENCE of the attainable score; otherwise fuse BM25 and
+    # vector rankings of HYBRID_CANDIDATES each with reciprocal rank fusion.
+    HYBRID = os.getenv("RAG_HYBRID", "true").lower() in ("1", "true", "yes")
+    LEXICAL_MIN_COVERAGE = float(os.getenv("RAG_LEXICAL_MIN_COVERAGE", "1.0"))
+    LEXICAL_MIN_CONFIDENCE = float(os.getenv("RAG_LEXICAL_MIN_CONFIDENCE", "0.6"))
+    HYBRID_CANDIDATES = int(os.getenv("RAG_HYBRID_CANDIDATES", "20"))
+    RRF_K = int(os.getenv("RAG_RRF_K", "60"))
+
+def chunk_text(text: str, max_tokens: int, overlap_tokens: int = 0) -> List[str]:
+    """Split text into overlapping chunks of at most ``max_tokens`` estimated tokens.
+
+    Paragraph boundaries are preferred; paragraphs that are too large on
+    their own are split on whitespace, and runs without whitespace (minified
+    code, base64) are cut every ``max_tokens`` worth of characters.
+    """
+    estimate = EmbeddingService.estimate_tokens
+    # Longest run of characters whose estimate still fits in max_tokens.
+    width = max(1, max_tokens - 1) * 4
+    pieces = []
+    for paragraph in re.split(r"(?<=\n\n)", text):
+        if not paragraph:
+            continue
+        if estimate(paragraph) <= max_tokens:
+            pieces.append(paragraph)
+            continue
+
+        words, tokens = [], 0
+        for run in re.findall(r"\S+\s*|\s+", paragraph):
+            for word in (run[i:i + width] for i in range(0, len(run), width)):
+                cost = estimate(word)
+                if words and tokens + cost > max_tokens:
+                    pieces.append("".join(words))
+                    words, tokens = [], 0
+                words.append(word)
+                tokens += cost
+        if words:
+            pieces.append("".join(words))
+
+    chunks = []
+    current: List[Tuple[str, int]] = []
+    for piece in pieces:
+        cost = estimate(piece)
+        if current and sum(c for _, c in current) + cost > max_tokens:
+            chunks.append("".join(p for p, _ in current))
+
+            overlap: List[Tuple[str, int]] = []
+            for p, c in reversed(current):
+                if sum(o for _, o in overlap) + c > overlap_tokens:
+                    break
+                overlap.insert(0, (p, c))
+            while overlap and sum(o for _, o in overlap) + cost > max_tokens:
+                overlap.pop(0)
+            current = overlap
+        current.append((piece, cost))
+
+    if current:
+        chunks.append("".join(p for p, _ in current))
+
+    return [chunk for chunk in chunks if chunk.strip()]
+
+class IVFIndex(EmbeddingIndex):
+    """Inverted-file approximate index over normalized embeddings.
+
+    Rows are clustered with spherical k-means; a query only scores the rows
+    in its ``nprobe`` closest clusters. Small indexes fall back to the exact
+    search of :class:`EmbeddingIndex`.
+    """
+
+    def __init__(self, datasets: Optional[List[Dict[str, Any]]] = None, min_size: int = RetrievalConfig.IVF_MIN_SIZE,
+                 nprobe: int = RetrievalConfig.IVF_NPROBE, iterations: int = RetrievalConfig.IVF_ITERATIONS, seed: int = 0):
+        self.min_size = min_size
+        self.nprobe = nprobe
+        self.iterations = iterations
+        self.seed = seed
+        self.centroids: Optional[np.ndarray] = None
+        self.order = np.zeros(0, dtype=np.int64)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        super().__init__(datasets)
+
+    def build(self, datasets: List[Dict[str, Any]]):
+        super().build(datasets)
+        self.centroids = None
+        if len(self.datasets) >= max(self.min_size, 1):
+            self.train()
+
+    def train(self):
+        rng = np.random.default_rng(self.seed)
+        rows = np.flatnonzero(self.valid)
+        if rows.size == 0:
+            return
+        n_lists = max(1, int(np.sqrt(rows.size)))
+
+        sample = rows
+        if rows.size > 256 * n_lists:
+            sample = rng.choice(rows, 256 * n_lists, replace=False)
+        training = self.matrix[sample]
+
+        centroids = training[rng.choice(training.shape[0], n_lists, replace=False)].copy()
+        for _ in range(self.iterations):
+            assignment = np.argmax(training @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, training)
+            empty = np.bincount(assignment, minlength=n_lists) == 0
+            sums[empty] = centroids[empty]
+            centroids, _ = self.normalize(sums)
+
+        assignment = np.argmax(self.matrix[rows] @ centroids.T, axis=1)
+        order = np.argsort(assignment, kind="stable")
+        self.centroids = np.ascontiguousarray(centroids)
+        self.order = rows[order]
+        self.offsets = np.searchsorted(assignment[order], np.arange(n_lists + 1))
+        print(f"Trained IVF index with {n_lists} lists over {rows.size} rows")
+
+    def search(self, target_embedding: Sequence[float], k: int = 1) -> List[Tuple[Dict[str, Any], float]]:
+        if self.centroids is None:
+            return super().search(target_embedding, k)
+
+        query, valid = self.normalize(np.asarray(target_embedding, dtype=np.float32))
+        if not valid or k <= 0:
+            return []
+
+        nprobe = min(self.nprobe, self.centroids.shape[0])
+        lists = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        candidates = np.concatenate([self.order[self.offsets[l]:self.offsets[l + 1]] for l in lists])
+        if candidates.size == 0:
+            return []
+
+        scores = self.matrix[candidates] @ query
+        k = min(k, scores.size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+
+        return [(self.datasets[candidates[i]], float(scores[i])) for i in top]
+
+class RetrievalSnapshot:
+    """One generation of the vector index, chunk text store and BM25 index.
+
+    A snapshot is never modified after it is published. Rebuilds publish a
+    new one by rebinding :attr:`Retriever.snapshot`, so a request that takes
+    the snapshot once sees a consistent view for its whole lifetime without
+    any locking.
+    """
+
+    def __init__(self, index: IVFIndex, store: DocumentStore, lexical: BM25Index, version: int = 0, missing: int = 0):
+        self.index = index
+        self.store = store
+        self.lexical = lexical
+        self.version = version
+        # Chunks of the corpus that failed to embed and are not searchable.
+        self.missing = missing
+
+class Retriever:
+    """Chunk documents, index the chunk embeddings and pack the best chunks into a context."""
+
+    def __init__(self, config: RetrievalConfig = RetrievalConfig()):
+        self.config = config
+        self.snapshot = RetrievalSnapshot(self.new_index(), create_document_store(), BM25Index())
+        self.force_rebuild = False
+
+    def new_index(self, chunks: Optional[List[Dict[str, Any]]] = None) -> IVFIndex:
+        return IVFIndex(chunks, min_size=self.config.IVF_MIN_SIZE, nprobe=self.config.IVF_NPROBE, iterations=self.config.IVF_ITERATIONS)
+
+    @property
+    def index(self) -> IVFIndex:
+        return self.snapshot.index
+
+    @property
+    def store(self) -> DocumentStore:
+        return self.snapshot.store
+
+    @property
+    def lexical(self) -> BM25Index:
+        return self.snapshot.lexical
+
+    @property
+    def chunks(self) -> List[Dict[str, Any]]:
+        return self.snapshot.index.datasets
+
+    def publish(self, index: IVFIndex, store: DocumentStore, lexical: BM25Index, missing: int = 0) -> RetrievalSnapshot:
+        # A single rebinding is atomic for readers on the event loop and in threads.
+        self.snapshot = RetrievalSnapshot(index, store, lexical, self.snapshot.version + 1, missing)
+        return self.snapshot
+
+    def chunk_documents(self, documents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        chunks = []
+        for document in documents:
+            for i, text in enumerate(chunk_text(document["content"], self.config.CHUNK_TOKENS, self.config.CHUNK_OVERLAP)):
+                chunks.append({"filename": document["filename"], "chunk": i, "content": text})
+        return chunks
+
+    async def embed(self, integration_id: str, api_token: str, filenames: List[str], documents: List[Dict[str, Any]],
+                    cache: Optional[EmbeddingCache]) -> Tuple[List[Dict[str, Any]], int]:
+        """Embed the chunks of ``documents``, returning them and the number that failed to embed."""
+        requested = self.chunk_documents(documents)
+        chunks = await EmbeddingService.embed_documents(integration_id, api_token, requested, cache)
+        if filenames and not chunks:
+            raise RuntimeError("Failed to embed any of the dataset files")
+        return chunks, len(requested) - len(chunks)
+
+    async def build(self, integration_id: str, api_token: str, filenames: List[str], cache: Optional[EmbeddingCache] = None) -> List[Dict[str, Any]]:
+        documents = await load_documents(filenames)
+        chunks, missing = await self.embed(integration_id, api_token, filenames, documents, cache)
+        return await self._build_local(chunks, missing)
+
+    async def _build_local(self, chunks: List[Dict[str, Any]], missing: int) -> List[Dict[str, Any]]:
+        # Build the new index and store off the event loop, then publish them
+        # together so readers never pair an index with another build's store.
+        store = create_document_store()
+        lexical = await asyncio.to_thread(self.new_lexical, chunks, [chunk["content"] for chunk in chunks])
+        await asyncio.to_thread(store.put, chunks)
+        index = await asyncio.to_thread(self.new_index, chunks)
+        self.compact(chunks)
+        self.publish(index, store, lexical, missing)
+        return chunks
+
+    async def load_or_build_shared(self, integration_id: str, api_token: str, filenames: List[str],
+                                   cache: Optional[EmbeddingCache], shared) -> List[Dict[str, Any]]:
+        """Attach the index published by another process, building and publishing it first if needed.
+
+        ``shared`` is a :class:`shared_index.SharedIndex`. Only one process
+        builds at a time; the others wait on its lock and then attach. A build
+        with chunks that failed to embed is served by this process only and
+        never published, so other workers and restarts do not take it for the
+        complete corpus.
+        """
+        documents = await load_documents(filenames)
+        fingerprint = shared.fingerprint(EmbeddingService.model_embeddings, self.config, documents)
+
+        if not self.force_rebuild:
+            attached = await asyncio.to_thread(shared.attach, fingerprint, self.config)
+            if attached is not None:
+                return await self._swap(*attached)
+
+        async with shared.lock():
+            # Another worker may have published while we waited for the lock.
+            if not self.force_rebuild:
+                attached = await asyncio.to_thread(shared.attach, fingerprint, self.config)
+                if attached is not None:
+                    return await self._swap(*attached)
+
+            chunks, missing = await self.embed(integration_id, api_token, filenames, documents, cache)
+            if missing:
+                print(f"Not publishing shared index: {missing} chunk(s) could not be embedded")
+                return await self._build_local(chunks, missing)
+            index = await asyncio.to_thread(self.new_index, chunks)
+            await asyncio.to_thread(shared.publish, fingerprint, index, chunks)
+            self.force_rebuild = False
+            attached = await asyncio.to_thread(shared.attach, fingerprint, self.config)
+            if attached is None:
+                raise RuntimeError("Published shared index could not be attached")
+            return await self._swap(*attached)
+
+    async def _swap(self, index: IVFIndex, store: DocumentStore, chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # The BM25 index is small and cheap to build, so each worker builds its own.
+        lexical = await asyncio.to_thread(self.new_lexical, chunks, [store.text(chunk) for chunk in chunks])
+        # The previous mapping is released once no request references it.
+        self.publish(index, store, lexical)
+        return chunks
+
+    def new_lexical(self, chunks: List[Dict[str, Any]], texts: List[str]) -> BM25Index:
+        lexical = BM25Index()
+        if self.config.HYBRID:
+            # File names such as request_format.md are good keywords for their chunks.
+            titles = [os.path.splitext(os.path.basename(chunk["filename"]))[0] for chunk in chunks]
+            lexical.build(chunks, [f"{title} {text}" for title, text in zip(titles, texts)])
+        return lexical
+
+    @staticmethod
+    def compact(chunks: List[Dict[str, Any]]):
+        """Drop per-chunk embedding lists once the index holds them as one float32 matrix."""
+        for chunk in chunks:
+            chunk.pop("embedding", None)
+
+    # The query methods below take an optional snapshot; callers that span an
+    # await should take ``retriever.snapshot`` once and pass it to each step.
+
+    def retrieve(self, target_embedding: Sequence[float], k: Optional[int] = None,
+                 lexical: Optional[List[Tuple[Dict[str, Any], float]]] = None,
+                 snapshot: Optional[RetrievalSnapshot] = None) -> List[Tuple[Dict[str, Any], float]]:
+        """Vector search, fused with ``lexical`` results by reciprocal rank when there are any."""
+        snapshot = snapshot or self.snapshot
+        k = k or self.config.TOP_K
+        if not lexical:
+            return snapshot.index.search(target_embedding, k)
+        vector = snapshot.index.search(target_embedding, max(k, self.config.HYBRID_CANDIDATES))
+        return reciprocal_rank_fusion([lexical, vector], k, self.config.RRF_K)
+
+    def retrieve_lexical(self, query: str, snapshot: Optional[RetrievalSnapshot] = None) -> Tuple[List[Tuple[Dict[str, Any], float]], bool]:
+        """BM25 candidates for ``query`` and whether they are confident enough to skip the embedding call."""
+        snapshot = snapshot or self.snapshot
+        if not self.config.HYBRID or not len(snapshot.lexical):
+            return [], False
+        results, confidence, coverage = snapshot.lexical.search(query, max(self.config.TOP_K, self.config.HYBRID_CANDIDATES))
+        confident = bool(results) and coverage >= self.config.LEXICAL_MIN_COVERAGE and confidence >= self.config.LEXICAL_MIN_CONFIDENCE
+        return results, confident
+
+    def pack_context(self, results: List[Tuple[Dict[str, Any], float]], budget: Optional[int] = None,
+                     snapshot: Optional[RetrievalSnapshot] = None) -> str:
+        """Join the highest scoring chunks that fit within ``budget`` estimated tokens."""
+        store = (snapshot or self.snapshot).store
+        budget = self.config.CONTEXT_TOKENS if budget is None else budget
+        parts, used = [], 0
+        for chunk, _ in results:
+            part = f"From {os.path.basename(chunk['filename'])}:\n{store.text(chunk).strip()}"
+            cost = EmbeddingService.estimate_tokens(part)
+            if used + cost > budget:
+                continue
+            parts.append(part)
+            used += cost
+
+        return "\n\n---\n\n".join(parts)
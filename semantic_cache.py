@@ -0,0 +1,125 @@
+import os
+import time
+import numpy as np
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, List, Optional, Sequence
+
+class SemanticCacheConfig:
+    ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+    THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+    SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "1000"))
+    TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+
+class SemanticCacheEntry:
+    def __init__(self, context_key: str, chunks: List[bytes], expires: float):
+        self.context_key = context_key
+        self.chunks = chunks
+        self.expires = expires
+
+class SemanticCache:
+    """Reuses streamed completions for near-duplicate queries answered from the same context.
+
+    Query embeddings live in a fixed-size float32 matrix, one row per slot, so
+    a lookup is a single matrix-vector product. Slots are evicted LRU-first
+    once the cache is full, and entries expire after ``ttl`` seconds.
+    """
+
+    def __init__(self, threshold: float = SemanticCacheConfig.THRESHOLD, maxsize: int = SemanticCacheConfig.SIZE,
+                 ttl: float = SemanticCacheConfig.TTL, enabled: bool = SemanticCacheConfig.ENABLED):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.matrix: Optional[np.ndarray] = None
+        self.entries: "OrderedDict[int, SemanticCacheEntry]" = OrderedDict()
+        self.free = list(range(maxsize - 1, -1, -1))
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @staticmethod
+    def _normalize(embedding: Sequence[float]) -> Optional[np.ndarray]:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return None
+        return vector / norm
+
+    def _evict(self, slot: int):
+        del self.entries[slot]
+        self.matrix[slot] = 0
+        self.free.append(slot)
+
+    def lookup(self, embedding: Sequence[float], context_key: str) -> Optional[SemanticCacheEntry]:
+        query = self._normalize(embedding)
+        if query is None or not self.entries or self.matrix is None or self.matrix.shape[1] != query.shape[0]:
+            self.misses += 1
+            return None
+
+        # Free slots are zero rows and score 0, below any useful threshold.
+        scores = self.matrix @ query
+        candidates = np.flatnonzero(scores >= self.threshold)
+        for slot in candidates[np.argsort(-scores[candidates])]:
+            slot = int(slot)
+            entry = self.entries.get(slot)
+            if entry is None:
+                continue
+            if entry.expires <= time.monotonic():
+                self._evict(slot)
+                continue
+            if entry.context_key != context_key:
+                continue
+
+            self.entries.move_to_end(slot)
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        return None
+
+    def store(self, embedding: Sequence[float], context_key: str, chunks: List[bytes]):
+        vector = self._normalize(embedding)
+        if vector is None or self.maxsize <= 0:
+            return
+
+        if self.matrix is None or self.matrix.shape[1] != vector.shape[0]:
+            self.matrix = np.zeros((self.maxsize, vector.shape[0]), dtype=np.float32)
+            self.entries.clear()
+            self.free = list(range(self.maxsize - 1, -1, -1))
+
+        if not self.free:
+            self._evict(next(iter(self.entries)))
+            self.evictions += 1
+
+        slot = self.free.pop()
+        self.matrix[slot] = vector
+        self.entries[slot] = SemanticCacheEntry(context_key, chunks, time.monotonic() + self.ttl)
+        self.stores += 1
+
+    async def record(self, embedding: Sequence[float], context_key: str, stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """Pass ``stream`` through, storing it only if it runs to completion."""
+        chunks = []
+        async for chunk in stream:
+            chunks.append(chunk)
+            yield chunk
+        self.store(embedding, context_key, [b"".join(chunks)])
+
+    @staticmethod
+    async def replay(entry: SemanticCacheEntry) -> AsyncIterator[bytes]:
+        for chunk in entry.chunks:
+            yield chunk
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "evictions": self.evictions,
+        }
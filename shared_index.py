@@ -0,0 +1,151 @@
+"""Embedding index shared between worker processes through memory-mapped files.
+
+The first worker to start (or ``python -m shared_index``) builds the index and
+publishes it under ``INDEX_DIR``; every worker then maps the same files
+read-only, so the matrix and chunk text live once in the page cache rather
+than once per process::
+
+    COPILOT_API_TOKEN=... python -m shared_index
+"""
+import os
+import time
+import fcntl
+import shutil
+import asyncio
+import hashlib
+import argparse
+import numpy as np
+import fast_json
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+from document_store import MmapDocumentStore
+from retrieval import IVFIndex, RetrievalConfig
+
+class SharedIndexConfig:
+    ENABLED = os.getenv("SHARED_INDEX", "true").lower() in ("1", "true", "yes")
+    DIRECTORY = os.getenv("INDEX_DIR", os.path.join(".cache", "index"))
+    KEEP_VERSIONS = int(os.getenv("INDEX_KEEP_VERSIONS", "2"))
+
+ARRAYS = ("matrix", "valid", "centroids", "order", "offsets")
+TEXT_FILE = "chunks.bin"
+META_FILE = "meta.json"
+
+class SharedIndex:
+    def __init__(self, directory: str = SharedIndexConfig.DIRECTORY, keep_versions: int = SharedIndexConfig.KEEP_VERSIONS):
+        self.directory = directory
+        self.keep_versions = keep_versions
+
+    @property
+    def current(self) -> str:
+        return os.path.join(self.directory, "current")
+
+    @staticmethod
+    def fingerprint(model: str, config: RetrievalConfig, documents: List[Dict[str, Any]]) -> str:
+        """Identify an index by embedding model, chunking settings and document contents."""
+        digest = hashlib.sha256()
+        digest.update(f"{model}\0{config.CHUNK_TOKENS}\0{config.CHUNK_OVERLAP}\0".encode("utf-8"))
+        for document in sorted(documents, key=lambda document: document["filename"]):
+            digest.update(document["filename"].encode("utf-8") + b"\0")
+            digest.update(hashlib.sha256(document["content"].encode("utf-8")).digest())
+        return digest.hexdigest()
+
+    def attach(self, fingerprint: str, config: RetrievalConfig) -> Optional[Tuple[IVFIndex, MmapDocumentStore, List[Dict[str, Any]]]]:
+        """Map the published index read-only if it matches ``fingerprint``."""
+        try:
+            version = os.path.realpath(self.current)
+            with open(os.path.join(version, META_FILE), "rb") as file:
+                meta = fast_json.loads(file.read())
+        except FileNotFoundError:
+            return None
+
+        if meta.get("fingerprint") != fingerprint:
+            return None
+
+        arrays = {}
+        for name in ARRAYS:
+            path = os.path.join(version, f"{name}.npy")
+            if os.path.exists(path):
+                arrays[name] = np.load(path, mmap_mode="r")
+
+        chunks = meta["chunks"]
+        index = IVFIndex.from_arrays(chunks, arrays["matrix"], np.asarray(arrays["valid"]),
+                                     min_size=config.IVF_MIN_SIZE, nprobe=config.IVF_NPROBE, iterations=config.IVF_ITERATIONS)
+        if "centroids" in arrays:
+            index.centroids = arrays["centroids"]
+            index.order = arrays["order"]
+            index.offsets = np.asarray(arrays["offsets"])
+
+        store = MmapDocumentStore(os.path.join(version, TEXT_FILE))
+        store.open()
+        print(f"Attached shared index {os.path.basename(version)} with {len(chunks)} chunks")
+        return index, store, chunks
+
+    def publish(self, fingerprint: str, index: IVFIndex, chunks: List[Dict[str, Any]]):
+        """Write ``index`` and the chunk text to a new version and make it current atomically."""
+        os.makedirs(self.directory, exist_ok=True)
+        version = os.path.join(self.directory, f"v-{time.time_ns()}-{os.getpid()}")
+        os.makedirs(version)
+
+        # Copy only what attach needs; put() replaces content with offsets on the copies.
+        stored = [{key: chunk[key] for key in ("filename", "chunk", "hash", "content") if key in chunk} for chunk in chunks]
+        store = MmapDocumentStore(os.path.join(version, TEXT_FILE))
+        store.put(stored)
+        store.close()
+        np.save(os.path.join(version, "matrix.npy"), np.ascontiguousarray(index.matrix, dtype=np.float32))
+        np.save(os.path.join(version, "valid.npy"), np.asarray(index.valid, dtype=bool))
+        if index.centroids is not None:
+            np.save(os.path.join(version, "centroids.npy"), index.centroids)
+            np.save(os.path.join(version, "order.npy"), index.order)
+            np.save(os.path.join(version, "offsets.npy"), index.offsets)
+
+        with open(os.path.join(version, META_FILE), "wb") as file:
+            file.write(fast_json.dumps_bytes({
+                "fingerprint": fingerprint,
+                "chunks": stored,
+            }))
+
+        # Swap the symlink in one rename so readers see either version, never a mix.
+        link = os.path.join(self.directory, f".current-{os.getpid()}")
+        os.symlink(os.path.basename(version), link)
+        os.replace(link, self.current)
+        print(f"Published shared index {os.path.basename(version)} with {len(chunks)} chunks")
+        self.prune()
+
+    def prune(self):
+        current = os.path.basename(os.path.realpath(self.current))
+        versions = sorted(name for name in os.listdir(self.directory) if name.startswith("v-"))
+        # Workers that still map an old version keep its pages until they detach.
+        for name in versions[:-self.keep_versions] if self.keep_versions > 0 else versions:
+            if name != current:
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    @asynccontextmanager
+    async def lock(self):
+        """Hold an exclusive cross-process lock so only one worker builds at a time."""
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(os.path.join(self.directory, ".lock"), os.O_CREAT | os.O_RDWR)
+        try:
+            await asyncio.to_thread(fcntl.flock, fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+async def build(force: bool = False):
+    from agent import agent_service
+    from upstream import upstream_client
+
+    if force:
+        agent_service.retriever.force_rebuild = True
+    try:
+        await agent_service.initialize_datasets(os.getenv("COPILOT_INTEGRATION_ID"), os.getenv("COPILOT_API_TOKEN"))
+    finally:
+        await upstream_client.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--force", action="store_true", help="rebuild even if the published index is up to date")
+    args = parser.parse_args()
+    asyncio.run(build(args.force))
+
+if __name__ == "__main__":
+    main()
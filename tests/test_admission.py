@@ -0,0 +1,43 @@
+import asyncio
+import pytest
+from admission import AdmissionController, AdmissionRejected
+
+def test_queued_requests_count_toward_user_limit():
+    async def scenario():
+        controller = AdmissionController(max_in_flight=1, queue_size=10, queue_timeout=5, user_rate=0, user_max_in_flight=2)
+        holder = await controller.acquire("other")
+
+        queued = [asyncio.create_task(controller.acquire("greedy")) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as error:
+            await controller.acquire("greedy")
+        assert error.value.reason == "user_concurrency"
+        assert len(controller.waiters) == 2
+
+        # A cancelled waiter gives its share back.
+        queued[1].cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await queued[1]
+        third = asyncio.create_task(controller.acquire("greedy"))
+        await asyncio.sleep(0)
+        assert not third.done()
+
+        holder.release()
+        (await queued[0]).release()
+        (await third).release()
+        assert controller.in_flight == 0
+        assert controller._user("greedy").in_flight == 0
+
+    asyncio.run(scenario())
+
+def test_queue_timeout_releases_user_share():
+    async def scenario():
+        controller = AdmissionController(max_in_flight=1, queue_size=10, queue_timeout=0.01, user_rate=0, user_max_in_flight=1)
+        holder = await controller.acquire("other")
+        with pytest.raises(AdmissionRejected) as error:
+            await controller.acquire("user")
+        assert error.value.reason == "queue_timeout"
+        assert controller._user("user").in_flight == 0
+        holder.release()
+
+    asyncio.run(scenario())
@@ -0,0 +1,26 @@
+import multiprocessing
+import numpy as np
+from embedding_cache import EmbeddingCache
+
+def _writer(directory, seed):
+    for i in range(20):
+        cache = EmbeddingCache("m", directory)
+        cache.load()
+        tag = f"{seed}-{i}"
+        cache.put(tag, np.full(4, seed * 1000 + i, dtype=np.float32))
+        cache.save(keep=[tag])
+
+def test_concurrent_savers_keep_manifest_and_matrix_paired(tmp_path):
+    directory = str(tmp_path)
+    processes = [multiprocessing.Process(target=_writer, args=(directory, seed)) for seed in (1, 2)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    cache = EmbeddingCache("m", directory)
+    cache.load()
+    assert cache.rows
+    for tag in cache.rows:
+        seed, i = map(int, tag.split("-"))
+        assert cache.get(tag)[0] == seed * 1000 + i
@@ -0,0 +1,13 @@
+from history import budget_messages
+
+def test_system_context_is_never_truncated():
+    context = {"role": "system", "content": "context " * 1500}
+    turns = []
+    for i in range(12):
+        turns.append({"role": "user", "content": f"question {i} " * 100})
+        turns.append({"role": "assistant", "content": f"answer {i} " * 100})
+    messages, report = budget_messages([context] + turns, max_tokens=4000, keep_recent=4)
+
+    assert messages[0] == context
+    assert messages[-1] == turns[-1]
+    assert report["dropped_messages"] > 0
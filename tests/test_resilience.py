@@ -0,0 +1,78 @@
+import asyncio
+import pytest
+from resilience import CircuitBreaker, CircuitOpenError, Resilience, UpstreamError
+
+def test_cancelled_half_open_probe_does_not_wedge_breaker():
+    async def scenario():
+        breaker = CircuitBreaker("t", failure_threshold=1, recovery_timeout=0.0)
+        resilience = Resilience("t", max_attempts=1, breaker=breaker)
+
+        async def unavailable():
+            raise UpstreamError(503)
+
+        with pytest.raises(UpstreamError):
+            await resilience.call(unavailable)
+        assert breaker.state == CircuitBreaker.OPEN
+
+        started = asyncio.Event()
+
+        async def hang():
+            started.set()
+            await asyncio.sleep(60)
+
+        probe = asyncio.create_task(resilience.call(hang))
+        await started.wait()
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        assert not breaker.probing
+
+        async def ok():
+            return "ok"
+
+        assert await resilience.call(ok) == "ok"
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    asyncio.run(scenario())
+
+def test_open_breaker_rejects_without_probe():
+    breaker = CircuitBreaker("t", failure_threshold=1, recovery_timeout=60.0)
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+def test_retry_after_beyond_max_delay_fails_fast():
+    async def scenario():
+        resilience = Resilience("t", max_attempts=3, max_delay=5.0, breaker=CircuitBreaker("t", failure_threshold=10))
+        calls = 0
+
+        async def limited():
+            nonlocal calls
+            calls += 1
+            raise UpstreamError(429, retry_after=30.0)
+
+        with pytest.raises(UpstreamError) as error:
+            await resilience.call(limited)
+        assert calls == 1
+        assert error.value.retry_after == 30.0
+        assert resilience.retries == 0
+
+    asyncio.run(scenario())
+
+def test_hedged_call_cancels_primary_on_deadline():
+    async def scenario():
+        resilience = Resilience("t", max_attempts=1, deadline=0.05, hedge_delay=1.0)
+        cancelled = asyncio.Event()
+
+        async def slow():
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        with pytest.raises(asyncio.TimeoutError):
+            await resilience.call(slow, hedge=True)
+        await asyncio.wait_for(cancelled.wait(), 1)
+
+    asyncio.run(scenario())
@@ -0,0 +1,10 @@
+import pytest
+from embedding import EmbeddingService
+from retrieval import chunk_text
+
+@pytest.mark.parametrize("text", ["a" * 1000, "x = 1; " * 10 + "b" * 999 + "\n\nshort paragraph"])
+def test_chunks_without_whitespace_stay_within_budget(text):
+    chunks = chunk_text(text, 50, 10)
+    assert len(chunks) > 1
+    assert all(EmbeddingService.estimate_tokens(chunk) <= 50 for chunk in chunks)
+    assert sum(len(chunk) for chunk in chunks) >= len(text.strip())
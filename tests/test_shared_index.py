@@ -0,0 +1,34 @@
+import asyncio
+from embedding import EmbeddingService
+from embedding_cache import EmbeddingCache
+from retrieval import Retriever
+from shared_index import SharedIndex
+
+def test_partial_build_is_not_published(tmp_path, monkeypatch):
+    (tmp_path / "a.md").write_text("alpha document")
+    (tmp_path / "b.md").write_text("beta document")
+    filenames = sorted(str(path) for path in tmp_path.glob("*.md"))
+    failing = {"beta document"}
+
+    async def embed_batched(texts, integration_id, api_token):
+        return [None if text in failing else [1.0, float(len(text))] for text in texts]
+
+    monkeypatch.setattr(EmbeddingService, "embed_batched", staticmethod(embed_batched))
+    shared = SharedIndex(str(tmp_path / "index"))
+    cache = EmbeddingCache("m", str(tmp_path / "cache"))
+
+    async def scenario():
+        retriever = Retriever()
+        chunks = await retriever.load_or_build_shared("id", "token", filenames, cache, shared)
+        assert len(chunks) == 1
+        assert retriever.snapshot.missing == 1
+        assert not (tmp_path / "index" / "current").exists()
+
+        failing.clear()
+        restarted = Retriever()
+        chunks = await restarted.load_or_build_shared("id", "token", filenames, cache, shared)
+        assert sorted(chunk["filename"] for chunk in chunks) == filenames
+        assert restarted.snapshot.missing == 0
+        assert (tmp_path / "index" / "current").exists()
+
+    asyncio.run(scenario())
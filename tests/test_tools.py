@@ -0,0 +1,40 @@
+import asyncio
+from collections import OrderedDict
+from copilot import ToolCallAssembler
+from tools import ToolContext, ToolRegistry, ToolResult
+
+def tool_chunk(index, name=None, arguments="", finish_reason=None):
+    function = {"arguments": arguments}
+    if name:
+        function["name"] = name
+    return {"choices": [{"index": 0, "delta": {"tool_calls": [{"index": index, "function": function}]}, "finish_reason": finish_reason}]}
+
+def test_completed_calls_run_while_streaming_and_only_once():
+    async def scenario():
+        registry = ToolRegistry()
+        calls = []
+
+        @registry.register("echo", "Echo", OrderedDict(), [])
+        async def echo(context, args):
+            calls.append(args["n"])
+            return ToolResult(str(args["n"]))
+
+        context = ToolContext(None, None)
+        assembler = ToolCallAssembler()
+        started = {}
+        for chunk in (tool_chunk(0, "echo", '{"n": '), tool_chunk(0, arguments="1}"), tool_chunk(1, "echo", '{"n": 2}'),
+                      {"choices": [{"index": 0, "delta": {}, "finish_reason": "tool_calls"}]}):
+            for call in assembler.feed(chunk):
+                registry.start(context, call, started)
+            await asyncio.sleep(0.01)
+            if len(started) == 1:
+                # The first call finished before the stream did.
+                assert calls == [1]
+
+        tool_calls = assembler.result()["choices"][0]["message"]["tool_calls"]
+        results = await registry.dispatch(context, tool_calls, started)
+        assert [result.content for result in results] == ["1", "2"]
+        assert calls == [1, 2]
+        assert not started
+
+    asyncio.run(scenario())
@@ -0,0 +1,75 @@
+import json
+import base64
+import asyncio
+import pytest
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+from verification import KEY_ID_HEADER, SIGNATURE_HEADER, FileKeySource, KeySource, PublicKeyCache, SignatureVerificationMiddleware
+
+BODY = b'{"messages": [{"role": "user", "content": "hi"}]}'
+
+@pytest.fixture
+def signer(tmp_path):
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    pem = private_key.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+    path = tmp_path / "keys.json"
+    path.write_text(json.dumps({"public_keys": [{"key_identifier": "k1", "key": pem.decode("utf-8"), "is_current": True}]}))
+
+    def sign(body: bytes) -> str:
+        return base64.b64encode(private_key.sign(body, ec.ECDSA(hashes.SHA256()))).decode("ascii")
+
+    return str(path), sign
+
+@pytest.fixture
+def client(signer):
+    async def agent(request):
+        return JSONResponse({"echo": (await request.body()).decode("utf-8")})
+
+    keys = PublicKeyCache(FileKeySource(signer[0]))
+    app = Starlette(routes=[Route("/agent", agent, methods=["POST"])])
+    app.add_middleware(SignatureVerificationMiddleware, keys=keys, paths=["/agent"])
+    with TestClient(app) as client:
+        yield client
+
+def post(client, body, headers):
+    return client.post("/agent", content=body, headers=headers)
+
+def test_valid_signature_passes_body_through(client, signer):
+    response = post(client, BODY, {KEY_ID_HEADER: "k1", SIGNATURE_HEADER: signer[1](BODY)})
+    assert response.status_code == 200
+    assert response.json()["echo"] == BODY.decode("utf-8")
+
+@pytest.mark.parametrize("body, key_id, signature", [
+    (BODY + b" ", "k1", None),
+    (BODY, "unknown", None),
+    (BODY, "k1", "not base64!"),
+])
+def test_invalid_signature_is_rejected(client, signer, body, key_id, signature):
+    response = post(client, body, {KEY_ID_HEADER: key_id, SIGNATURE_HEADER: signature or signer[1](BODY)})
+    assert response.status_code == 401
+
+@pytest.mark.parametrize("drop", [KEY_ID_HEADER, SIGNATURE_HEADER])
+def test_missing_headers_are_rejected(client, signer, drop):
+    headers = {KEY_ID_HEADER: "k1", SIGNATURE_HEADER: signer[1](BODY)}
+    del headers[drop]
+    assert post(client, BODY, headers).status_code == 401
+
+def test_failing_key_endpoint_is_not_refetched_per_request():
+    class Unavailable(KeySource):
+        calls = 0
+
+        async def fetch(self):
+            Unavailable.calls += 1
+            raise RuntimeError("503")
+
+    async def scenario():
+        keys = PublicKeyCache(Unavailable(), min_refetch_interval=60)
+        for _ in range(5):
+            assert await keys.get("k1") is None
+        assert Unavailable.calls == 1
+
+    asyncio.run(scenario())
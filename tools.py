@@ -0,0 +1,102 @@
+import os
+import fast_json
+import asyncio
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+class ToolContext:
+    """Per-request state shared by the tool handlers of one function-calling run."""
+
+    def __init__(self, integration_id: Optional[str], api_token: Optional[str]):
+        self.integration_id = integration_id
+        self.api_token = api_token
+        self.confirmations: List[Dict[str, Any]] = []
+
+class ToolResult:
+    """Content for the ``tool`` message plus any SSE events to emit to the client."""
+
+    def __init__(self, content: str, events: Optional[List[Dict[str, Any]]] = None):
+        self.content = content
+        self.events = events or []
+
+class Tool:
+    def __init__(self, name: str, description: str, parameters: "OrderedDict[str, Dict[str, Any]]", required: List[str],
+                 handler: Callable[[ToolContext, Dict[str, Any]], Awaitable[ToolResult]], timeout: Optional[float] = None):
+        self.name = name
+        self.description = description
+        self.parameters = parameters
+        self.required = required
+        self.handler = handler
+        self.timeout = timeout
+
+    @property
+    def definition(self) -> Dict[str, Any]:
+        return {
+            "type": "function",
+            "function": {
+                "name": self.name,
+                "description": self.description,
+                "parameters": {
+                    "type": "object",
+                    "properties": self.parameters,
+                    "required": self.required,
+                },
+            },
+        }
+
+class ToolRegistry:
+    default_timeout = float(os.getenv("TOOL_TIMEOUT", "30"))
+
+    def __init__(self):
+        self.tools: "OrderedDict[str, Tool]" = OrderedDict()
+
+    def register(self, name: str, description: str, parameters: "OrderedDict[str, Dict[str, Any]]", required: List[str], timeout: Optional[float] = None):
+        """Decorator registering an async ``handler(context, args) -> ToolResult``."""
+        def decorator(handler):
+            self.tools[name] = Tool(name, description, parameters, required, handler, timeout)
+            return handler
+        return decorator
+
+    @property
+    def definitions(self) -> List[Dict[str, Any]]:
+        return [tool.definition for tool in self.tools.values()]
+
+    async def call(self, context: ToolContext, tool_call: Dict[str, Any]) -> ToolResult:
+        function = tool_call.get("function") or {}
+        name = function.get("name")
+        tool = self.tools.get(name)
+        if tool is None:
+            return ToolResult(f"Error: unknown tool {name}")
+
+        try:
+            args = fast_json.loads(function.get("arguments") or "{}")
+        except Exception as e:
+            return ToolResult(f"Error: invalid arguments for {name}: {e}")
+
+        timeout = tool.timeout if tool.timeout is not None else self.default_timeout
+        try:
+            return await asyncio.wait_for(tool.handler(context, args), timeout)
+        except asyncio.TimeoutError:
+            print(f"Tool {name} timed out after {timeout}s")
+            return ToolResult(f"Error: {name} timed out")
+        except Exception as e:
+            print(f"Tool {name} failed: {e}")
+            return ToolResult(f"Error in {name}: {e}")
+
+    def start(self, context: ToolContext, tool_call: Dict[str, Any], started: Dict[int, asyncio.Task]):
+        """Start ``tool_call`` in the background and record its task in ``started`` for :meth:`dispatch`."""
+        started[id(tool_call)] = asyncio.create_task(self.call(context, tool_call))
+
+    async def dispatch(self, context: ToolContext, tool_calls: List[Dict[str, Any]],
+                       started: Optional[Dict[int, asyncio.Task]] = None) -> List[ToolResult]:
+        """Run every tool call concurrently, returning results in call order.
+
+        Calls already running in ``started`` are awaited rather than run
+        again; started calls that are not in ``tool_calls`` are cancelled.
+        """
+        started = started if started is not None else {}
+        pending = [started.pop(id(tool_call), None) or self.call(context, tool_call) for tool_call in tool_calls]
+        for task in started.values():
+            task.cancel()
+        started.clear()
+        return list(await asyncio.gather(*pending))
@@ -0,0 +1,103 @@
+import os
+import time
+import aiohttp
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+from metrics import UPSTREAM_ERRORS, UPSTREAM_TTFB_SECONDS
+from resilience import UpstreamError, parse_retry_after
+
+class UpstreamConfig:
+    COPILOT_API_URL = os.getenv("COPILOT_API_URL", "https://api.githubcopilot.com").rstrip("/")
+    LIMIT = int(os.getenv("UPSTREAM_LIMIT", "100"))
+    LIMIT_PER_HOST = int(os.getenv("UPSTREAM_LIMIT_PER_HOST", "50"))
+    KEEPALIVE_TIMEOUT = float(os.getenv("UPSTREAM_KEEPALIVE_TIMEOUT", "30"))
+    DNS_CACHE_TTL = int(os.getenv("UPSTREAM_DNS_CACHE_TTL", "300"))
+    CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "10"))
+    READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "60"))
+    TOTAL_TIMEOUT = float(os.getenv("UPSTREAM_TOTAL_TIMEOUT", "300"))
+
+class UpstreamClient:
+    """Owns the pooled aiohttp session shared by every upstream call."""
+
+    def __init__(self, config: UpstreamConfig = UpstreamConfig()):
+        self.config = config
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def start(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.config.LIMIT,
+                limit_per_host=self.config.LIMIT_PER_HOST,
+                keepalive_timeout=self.config.KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=self.config.DNS_CACHE_TTL,
+                use_dns_cache=True,
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=self.config.TOTAL_TIMEOUT,
+                sock_connect=self.config.CONNECT_TIMEOUT,
+                sock_read=self.config.READ_TIMEOUT,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            print("Upstream client session started")
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            print("Upstream client session closed")
+        self._session = None
+
+    async def session(self) -> aiohttp.ClientSession:
+        # Lazily start the session so the services still work outside of the
+        # application lifespan (scripts, one-off calls).
+        if self._session is None or self._session.closed:
+            return await self.start()
+        return self._session
+
+    async def open(self, endpoint: str, url: str, **kwargs) -> aiohttp.ClientResponse:
+        """POST through the shared session and return the response once headers arrive.
+
+        Records time-to-headers and errors under ``endpoint``. Non-200 responses
+        are read, released and raised as :class:`UpstreamError`; the caller owns
+        (and must release) a successful response.
+        """
+        session = await self.session()
+        start = time.perf_counter()
+        try:
+            response = await session.post(url, **kwargs)
+        except Exception:
+            UPSTREAM_ERRORS.inc(endpoint=endpoint)
+            raise
+
+        UPSTREAM_TTFB_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+        if response.status != 200:
+            UPSTREAM_ERRORS.inc(endpoint=endpoint)
+            try:
+                error_message = await response.text()
+            finally:
+                response.release()
+            raise UpstreamError(response.status, error_message, parse_retry_after(response.headers.get("Retry-After")))
+
+        return response
+
+    @asynccontextmanager
+    async def post(self, endpoint: str, url: str, **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+        response = await self.open(endpoint, url, **kwargs)
+        async with response:
+            yield response
+
+    def url(self, path: str) -> str:
+        return f"{self.config.COPILOT_API_URL}/{path.lstrip('/')}"
+
+    @staticmethod
+    def headers(api_token: str, integration_id: Optional[str]) -> dict:
+        headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Authorization": f"Bearer {api_token}",
+        }
+        if integration_id:
+            headers["Copilot-Integration-Id"] = integration_id
+        return headers
+
+upstream_client = UpstreamClient()
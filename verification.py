@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import base64
+import asyncio
+from typing import Any, Dict, Iterable, List, Optional
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from starlette.responses import JSONResponse
+from upstream import upstream_client
+
+KEY_ID_HEADER = "github-public-key-identifier"
+SIGNATURE_HEADER = "github-public-key-signature"
+
+class VerificationConfig:
+    ENABLED = os.getenv("VERIFY_SIGNATURES", "false").lower() in ("1", "true", "yes")
+    KEYS_URL = os.getenv("GITHUB_PUBLIC_KEYS_URL", "https://api.github.com/meta/public_keys/copilot_api")
+    KEYS_FILE = os.getenv("GITHUB_PUBLIC_KEYS_FILE")
+    KEYS_TTL = float(os.getenv("GITHUB_PUBLIC_KEYS_TTL", "3600"))
+    # Minimum seconds between refetches triggered by unknown key ids, so
+    # requests with made-up ids cannot hammer the key endpoint.
+    UNKNOWN_KEY_REFETCH_INTERVAL = float(os.getenv("GITHUB_PUBLIC_KEYS_MIN_REFETCH", "30"))
+
+class KeySource:
+    """Returns the raw ``public_keys`` entries, each with ``key_identifier`` and a PEM ``key``."""
+
+    async def fetch(self) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+class GitHubKeySource(KeySource):
+    def __init__(self, url: str = VerificationConfig.KEYS_URL, token: Optional[str] = None):
+        self.url = url
+        self.token = token
+
+    async def fetch(self) -> List[Dict[str, Any]]:
+        headers = {"Accept": "application/json"}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+
+        session = await upstream_client.session()
+        async with session.get(self.url, headers=headers) as response:
+            if response.status != 200:
+                error_message = await response.text()
+                raise RuntimeError(f"Unexpected status code: {response.status}, {error_message}")
+            return (await response.json()).get("public_keys", [])
+
+class FileKeySource(KeySource):
+    """Reads keys from a local JSON file in the same shape as the GitHub endpoint."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _read(self) -> List[Dict[str, Any]]:
+        with open(self.path, "r") as file:
+            return json.load(file).get("public_keys", [])
+
+    async def fetch(self) -> List[Dict[str, Any]]:
+        return await asyncio.to_thread(self._read)
+
+class PublicKeyCache:
+    """In-process cache of parsed public keys, refreshed on a TTL in the background.
+
+    Lookups of known key ids never touch the network; an unknown id triggers
+    at most one single-flight refetch per ``min_refetch_interval``.
+    """
+
+    def __init__(self, source: KeySource, ttl: float = VerificationConfig.KEYS_TTL,
+                 min_refetch_interval: float = VerificationConfig.UNKNOWN_KEY_REFETCH_INTERVAL):
+        self.source = source
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.keys: Dict[str, ec.EllipticCurvePublicKey] = {}
+        self.fetched_at: Optional[float] = None
+        # Last fetch attempt, successful or not; unknown-id refetches are throttled on it.
+        self.attempted_at: Optional[float] = None
+        self._refresh: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def parse(entries: Iterable[Dict[str, Any]]) -> Dict[str, ec.EllipticCurvePublicKey]:
+        keys = {}
+        for entry in entries:
+            try:
+                keys[entry["key_identifier"]] = serialization.load_pem_public_key(entry["key"].encode("utf-8"))
+            except Exception as e:
+                print(f"Skipping unparsable public key {entry.get('key_identifier')}: {e}")
+        return keys
+
+    async def _fetch(self):
+        self.attempted_at = time.monotonic()
+        keys = self.parse(await self.source.fetch())
+        self.keys = keys
+        self.fetched_at = time.monotonic()
+        print(f"Loaded {len(keys)} public keys")
+
+    async def refresh(self):
+        """Refetch the key list, sharing one in-flight fetch between callers."""
+        if self._refresh is None or self._refresh.done():
+            self._refresh = asyncio.ensure_future(self._fetch())
+        await asyncio.shield(self._refresh)
+
+    async def get(self, key_id: str) -> Optional[ec.EllipticCurvePublicKey]:
+        key = self.keys.get(key_id)
+        if key is not None:
+            return key
+
+        # Join a fetch already in flight, otherwise refetch at most once per interval
+        # even while the key endpoint keeps failing.
+        in_flight = self._refresh is not None and not self._refresh.done()
+        if not in_flight and self.attempted_at is not None and time.monotonic() - self.attempted_at < self.min_refetch_interval:
+            return None
+
+        try:
+            await self.refresh()
+        except Exception as e:
+            print(f"Failed to refresh public keys: {e}")
+        return self.keys.get(key_id)
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.ttl)
+            try:
+                await self.refresh()
+            except Exception as e:
+                # Keep serving the previous keys until a refresh succeeds.
+                print(f"Failed to refresh public keys: {e}")
+
+    async def start(self):
+        try:
+            await self.refresh()
+        except Exception as e:
+            print(f"Failed to load public keys: {e}")
+        if self._loop is None:
+            self._loop = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._loop is not None:
+            self._loop.cancel()
+            self._loop = None
+
+    async def verify(self, body: bytes, key_id: str, signature: str) -> bool:
+        key = await self.get(key_id)
+        if key is None:
+            return False
+
+        try:
+            key.verify(base64.b64decode(signature), body, ec.ECDSA(hashes.SHA256()))
+        except (InvalidSignature, ValueError):
+            return False
+        return True
+
+def create_key_source() -> KeySource:
+    if VerificationConfig.KEYS_FILE:
+        return FileKeySource(VerificationConfig.KEYS_FILE)
+    return GitHubKeySource()
+
+class SignatureVerificationMiddleware:
+    """ASGI middleware rejecting requests to ``paths`` without a valid GitHub payload signature.
+
+    The body is buffered once to verify it and then replayed to the app.
+    """
+
+    def __init__(self, app, keys: PublicKeyCache, paths: Iterable[str] = ("/agent",)):
+        self.app = app
+        self.keys = keys
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+        key_id = headers.get(KEY_ID_HEADER)
+        signature = headers.get(SIGNATURE_HEADER)
+        if not key_id or not signature:
+            await JSONResponse({"error": "Missing payload signature"}, status_code=401)(scope, receive, send)
+            return
+
+        chunks = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunks.append(message.get("body", b""))
+            more_body = message.get("more_body", False)
+        body = b"".join(chunks)
+
+        if not await self.keys.verify(body, key_id, signature):
+            await JSONResponse({"error": "Invalid payload signature"}, status_code=401)(scope, receive, send)
+            return
+
+        replayed = False
+
+        async def replay():
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        await self.app(scope, replay, send)